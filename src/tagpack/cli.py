@@ -3,10 +3,14 @@ import os
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 from argparse import ArgumentParser
+from collections import Counter
+from contextlib import closing
 from functools import partial
 from multiprocessing import Pool, cpu_count
+from multiprocessing.util import Finalize
 
 import pandas as pd
 import yaml
@@ -21,6 +25,7 @@ from yaml.parser import ParserError, ScannerError
 from tagpack import get_version
 from tagpack.actorpack import Actor, ActorPack
 from tagpack.actorpack_schema import ActorPackSchema
+from tagpack.cluster_cache import ClusterMappingCache
 from tagpack.cmd_utils import (
     print_fail,
     print_info,
@@ -28,7 +33,13 @@ from tagpack.cmd_utils import (
     print_success,
     print_warn,
 )
-from tagpack.graphsense import GraphSense
+from tagpack.graphsense import (
+    _MAX_CONCURRENCY,
+    _MIN_CONCURRENCY,
+    GraphSense,
+    is_eth_like,
+    token_range_splits,
+)
 from tagpack.tagpack import (
     TagPack,
     TagPackFileError,
@@ -39,7 +50,7 @@ from tagpack.tagpack import (
 from tagpack.tagpack_schema import TagPackSchema, ValidationError
 from tagpack.tagstore import InsertTagpackWorker, TagStore
 from tagpack.taxonomy import Taxonomy
-from tagpack.utils import strip_empty
+from tagpack.utils import BloomFilter, strip_empty
 
 init()
 
@@ -493,31 +504,6 @@ def insert_tagpack(args):
     print_info(msg)
 
 
-def _split_into_chunks(seq, size):
-    return (seq[pos : pos + size] for pos in range(0, len(seq), size))
-
-
-def insert_cluster_mapping_wp(network, ks_mapping, args, batch):
-    tagstore = TagStore(args.url, args.schema)
-    gs = GraphSense(
-        args.db_nodes,
-        ks_mapping,
-        username=args.cassandra_username,
-        password=args.cassandra_password,
-    )
-    if gs.keyspace_for_network_exists(network):
-        clusters = gs.get_address_clusters(batch, network)
-        clusters["network"] = network
-        tagstore.insert_cluster_mappings(clusters)
-    else:
-        clusters = []
-        print_fail(
-            "At least one of the configured keyspaces"
-            f" for network {network} does not exist."
-        )
-    return (network, len(clusters))
-
-
 def load_ks_mapping(args):
     if args.use_gs_lib_config_env:
         gs_config_file = os.path.expanduser("~/.graphsense.yaml")
@@ -559,47 +545,337 @@ def load_ks_mapping(args):
             sys.exit(1)
 
 
-def insert_cluster_mapping(args, batch_size=5_000):
+_mapping_worker_config = None
+_mapping_worker_connections = None
+_mapping_worker_address_filters = {}
+
+
+def _init_cluster_mapping_worker(ks_mapping, args):
+    # passed once per worker process instead of with every work package
+    global _mapping_worker_config
+    _mapping_worker_config = (ks_mapping, args)
+
+
+def _get_cluster_mapping_worker_connections():
+    """Postgres connection and Cassandra session of this worker process,
+    opened on its first batch and kept for the whole run."""
+    global _mapping_worker_connections
+    if _mapping_worker_connections is None:
+        ks_mapping, args = _mapping_worker_config
+        tagstore = TagStore(args.url, args.schema)
+        gs = GraphSense(
+            args.db_nodes,
+            ks_mapping,
+            username=args.cassandra_username,
+            password=args.cassandra_password,
+            min_concurrency=args.min_concurrency,
+            max_concurrency=args.max_concurrency,
+            group_by_partition=args.group_by_partition,
+            cache=ClusterMappingCache(args.cache_file) if args.cache_file else None,
+        )
+        _mapping_worker_connections = (tagstore, gs)
+        # runs when the worker exits after pool.close() and pool.join()
+        Finalize(None, _close_cluster_mapping_worker_connections, exitpriority=10)
+    return _mapping_worker_connections
+
+
+def _close_cluster_mapping_worker_connections():
+    global _mapping_worker_connections
+    if _mapping_worker_connections is not None:
+        tagstore, gs = _mapping_worker_connections
+        _mapping_worker_connections = None
+        tagstore.close()
+        gs.close()
+
+
+def _record_mapping_batch(tagstore, run_id, network, first, last, addresses, clusters):
+    """Records the addresses of a processed batch as mapped or not found and
+    checkpoints the batch."""
+    mapped = set(clusters["address"]) if not clusters.empty else set()
+    tagstore.set_address_mapping_status(
+        run_id, network, [a for a in addresses if a in mapped], "mapped"
+    )
+    tagstore.set_address_mapping_status(
+        run_id, network, [a for a in addresses if a not in mapped], "not_found"
+    )
+    tagstore.add_mapping_checkpoint(run_id, network, first, last, "done", len(mapped))
+
+
+def _record_failed_batch(tagstore, run_id, network, first, last, addresses, e):
+    print_fail(f"{network} batch {first} - {last} failed: {e}")
+    tagstore.set_address_mapping_status(
+        run_id, network, addresses, "failed", error=str(e)
+    )
+    tagstore.add_mapping_checkpoint(run_id, network, first, last, "failed", 0)
+
+
+def _record_missing_keyspace(tagstore, run_id, network, first, last, addresses):
+    """Records the batch as failed, so the run stays open and is retried on
+    resume. It doesn't count as a failed batch, the other networks are still
+    processed."""
+    _record_failed_batch(
+        tagstore,
+        run_id,
+        network,
+        first,
+        last,
+        addresses,
+        "At least one of the configured keyspaces does not exist",
+    )
+
+
+def insert_cluster_mapping_wp(network, first, last, update_existing, run_id):
+    """Maps the addresses of network in the key range [first, last]; returns
+    (network, number of mapped addresses, whether the batch failed)."""
+    tagstore, gs = _get_cluster_mapping_worker_connections()
+    batch = pd.DataFrame(
+        tagstore.get_addresses_in_range(network, first, last, update_existing, run_id),
+        columns=["address", "network"],
+    )
+    if batch.empty:
+        return (network, 0, False)
+
+    addresses = batch["address"].tolist()
+    if not gs.keyspace_for_network_exists(network):
+        _record_missing_keyspace(tagstore, run_id, network, first, last, addresses)
+        return (network, 0, False)
+
+    try:
+        clusters = gs.get_address_clusters(batch, network)
+        if not clusters.empty:
+            clusters["network"] = network
+            tagstore.insert_cluster_mappings(clusters)
+    except Exception as e:
+        _record_failed_batch(tagstore, run_id, network, first, last, addresses, e)
+        return (network, 0, True)
+
+    _record_mapping_batch(tagstore, run_id, network, first, last, addresses, clusters)
+    return (network, len(clusters), False)
+
+
+def _get_address_filter(tagstore, network, update_existing, run_id):
+    """Bloom filter of the addresses of network to map, built once per
+    worker process."""
+    address_filter = _mapping_worker_address_filters.get(network, None)
+    if address_filter is None:
+        address_filter = BloomFilter(
+            tagstore.get_addresses_count(network, update_existing, run_id)
+        )
+        addresses = tagstore.iter_network_addresses(
+            network, update_existing, run_id=run_id
+        )
+        for address in addresses:
+            address_filter.add(address)
+        _mapping_worker_address_filters[network] = address_filter
+    return address_filter
+
+
+def scan_cluster_mapping_wp(network, first_token, last_token, update_existing, run_id):
+    """Maps the addresses of network found in the token range
+    (first_token, last_token] of its address table; returns (network, number
+    of mapped addresses, whether the range failed)."""
+    tagstore, gs = _get_cluster_mapping_worker_connections()
+    if not gs.keyspace_for_network_exists(network):
+        _record_missing_keyspace(tagstore, run_id, network, first_token, last_token, [])
+        return (network, 0, False)
+
+    addresses = []
+    try:
+        address_filter = _get_address_filter(tagstore, network, update_existing, run_id)
+        found = gs.scan_addresses(network, first_token, last_token, address_filter)
+        if not found.empty:
+            # drop the false positives of the filter
+            known = tagstore.filter_network_addresses(
+                network, found["address"].tolist(), update_existing, run_id
+            )
+            found = found[found["address"].isin(known)]
+        addresses = found["address"].tolist() if not found.empty else []
+
+        clusters = pd.DataFrame()
+        if addresses:
+            clusters = gs.get_clusters_of_address_ids(found, network)
+        if not clusters.empty:
+            clusters["network"] = network
+            tagstore.insert_cluster_mappings(clusters)
+    except Exception as e:
+        _record_failed_batch(
+            tagstore, run_id, network, first_token, last_token, addresses, e
+        )
+        return (network, 0, True)
+
+    _record_mapping_batch(
+        tagstore, run_id, network, first_token, last_token, addresses, clusters
+    )
+    return (network, len(clusters), False)
+
+
+def _use_full_scan(args, tagstore, gs, network) -> bool:
+    """Whether to map network by scanning its address table instead of
+    looking up its addresses; auto scans if the addresses to map are at least
+    scan_ratio of the addresses in the keyspace."""
+    if is_eth_like(network):
+        if args.mapping_mode == "scan":
+            print_warn(f"{network} can't be scanned, using lookups")
+        return False
+    if args.mapping_mode != "auto":
+        return args.mapping_mode == "scan"
+    if not gs.keyspace_for_network_exists(network):
+        return False
+
+    total = gs.get_address_count(network)
+    if not total:
+        return False
+    ratio = tagstore.get_addresses_count(network, args.update) / total
+    print_info(f"{network}: {ratio:.2%} of the keyspace addresses to map")
+    return ratio >= args.scan_ratio
+
+
+def _scan_splits_done(tagstore, run_id, network, splits) -> bool:
+    done = tagstore.get_mapping_checkpoints(run_id, network)
+    return all((str(first), str(last)) in done for first, last in splits)
+
+
+def _cluster_mapping_tasks(args, tagstore, run_id, network, scan, batch_size):
+    """Yields (worker function, arguments) of the batches of network still to
+    process in run_id; token ranges scanned already are skipped, lookups only
+    select addresses not mapped or found missing in the run."""
+    # failed batches are retried below, scanned token ranges under the same
+    # checkpoint, looked up addresses in new key ranges
+    tagstore.delete_failed_mapping_checkpoints(run_id, network)
+    if scan:
+        print_info(f"{network}: scanning in {args.scan_splits} token ranges")
+        done = tagstore.get_mapping_checkpoints(run_id, network)
+        for first, last in token_range_splits(args.scan_splits):
+            if (str(first), str(last)) in done:
+                continue
+            yield scan_cluster_mapping_wp, (network, first, last, args.update, run_id)
+    else:
+        key_ranges = tagstore.get_address_key_ranges(
+            network, args.update, batch_size, run_id
+        )
+        with closing(key_ranges):
+            for first, last in key_ranges:
+                fn_args = (network, first, last, args.update, run_id)
+                yield insert_cluster_mapping_wp, fn_args
+
+
+def _start_mapping_run(args, tagstore) -> int:
+    """Id of the mapping run to process: the latest unfinished one on resume
+    (with its update flag), a new one otherwise."""
+    if args.resume:
+        run = tagstore.get_unfinished_mapping_run()
+        if run is not None:
+            run_id, args.update = run
+            print_info(
+                f"Resuming cluster mapping run {run_id}"
+                f"{' (update all)' if args.update else ''}"
+            )
+            return run_id
+        print_info("No unfinished cluster mapping run, starting a new one")
+    return tagstore.start_mapping_run(args.update)
+
+
+def insert_cluster_mapping(
+    args, batch_size=5_000, max_in_flight=None, max_failed_batches=10
+):
     t0 = time.time()
     tagstore = TagStore(args.url, args.schema)
-    df = pd.DataFrame(
-        tagstore.get_addresses(args.update), columns=["address", "network"]
-    )
     ks_mapping = load_ks_mapping(args)
     print("Importing with mapping config: ", ks_mapping)
     networks = ks_mapping.keys()
-    gs = GraphSense(
-        args.db_nodes,
-        ks_mapping,
-        username=args.cassandra_username,
-        password=args.cassandra_password,
-    )
-
-    workpackages = []
-    for network, data in df.groupby("network"):
-        if gs.contains_keyspace_mapping(network):
-            for batch in _split_into_chunks(data, batch_size):
-                workpackages.append((network, ks_mapping, args, batch))
+    run_id = _start_mapping_run(args, tagstore)
 
     nr_workers = int(cpu_count() / 2)
     print(
-        f"Processing {len(workpackages)} batches for "
-        f"{len(networks)} networks on {nr_workers} workers."
+        f"Processing {len(networks)} networks in batches of {batch_size} "
+        f"addresses on {nr_workers} workers."
     )
 
-    with Pool(processes=nr_workers, maxtasksperchild=1) as pool:
-        processed_workpackages = pool.starmap(insert_cluster_mapping_wp, workpackages)
+    if args.mapping_mode == "auto":
+        gs = GraphSense(
+            args.db_nodes,
+            ks_mapping,
+            username=args.cassandra_username,
+            password=args.cassandra_password,
+        )
+        scan = {n: _use_full_scan(args, tagstore, gs, n) for n in networks}
+        gs.close()
+    else:
+        scan = {n: _use_full_scan(args, tagstore, None, n) for n in networks}
+
+    # the driver only reads batch boundaries, workers load their batches
+    # themselves; at most max_in_flight batches are queued or processed
+    in_flight = threading.BoundedSemaphore(max_in_flight or 2 * nr_workers)
+    mappings_count = Counter()
+    failed_batches = Counter()
+    errors = []
+
+    def done(result):
+        network, items, batch_failed = result
+        mappings_count[network] += items
+        if batch_failed:
+            failed_batches[network] += 1
+        in_flight.release()
+
+    def failed(e):
+        errors.append(e)
+        in_flight.release()
+
+    def stop():
+        return errors or sum(failed_batches.values()) >= max_failed_batches
+
+    with Pool(
+        processes=nr_workers,
+        initializer=_init_cluster_mapping_worker,
+        initargs=(ks_mapping, args),
+    ) as pool:
+        for network in networks:
+            tasks = _cluster_mapping_tasks(
+                args, tagstore, run_id, network, scan[network], batch_size
+            )
+            # closes the server side cursor of the key ranges when stopping
+            # early, before the tagstore connection is used again
+            with closing(tasks):
+                for fn, fn_args in tasks:
+                    in_flight.acquire()
+                    if stop():
+                        in_flight.release()
+                        break
+                    pool.apply_async(fn, fn_args, callback=done, error_callback=failed)
+            if stop():
+                break
+        pool.close()
+        pool.join()
+
+    if errors:
+        raise errors[0]
+
+    # addresses not found in any token range are not in the keyspace; the
+    # run is incomplete while token ranges are left to scan
+    complete = not stop()
+    splits = token_range_splits(args.scan_splits)
+    for network in networks:
+        if not scan[network]:
+            continue
+        if _scan_splits_done(tagstore, run_id, network, splits):
+            tagstore.mark_unmapped_not_found(run_id, network, args.update)
+        else:
+            complete = False
 
-    processed_networks = {network for network, _ in processed_workpackages}
+    processed_networks = set(mappings_count.keys())
 
     for pc in processed_networks:
-        mappings_count = sum(
-            [items for network, items in processed_workpackages if network == pc]
-        )
-        print_success(f"INSERTED/UPDATED {mappings_count} {pc} cluster mappings")
+        print_success(f"INSERTED/UPDATED {mappings_count[pc]} {pc} cluster mappings")
 
-    tagstore.finish_mappings_update(networks)
+    failed_addresses, failed_ranges = tagstore.finish_mappings_update(run_id, complete)
     duration = round(time.time() - t0, 2)
+    if sum(failed_batches.values()) >= max_failed_batches:
+        print_fail(f"Stopped after {sum(failed_batches.values())} failed batches")
+    if failed_addresses or failed_ranges or not complete:
+        print_fail(
+            f"Run {run_id} is incomplete ({failed_addresses} addresses and "
+            f"{failed_ranges} batches failed), continue it with --resume"
+        )
     print_line(
         f"Inserted {'missing' if not args.update else 'all'} cluster mappings "
         f"for {processed_networks} in {duration}s",
@@ -1563,6 +1839,66 @@ def main():
         "-u", "--url", help="postgresql://user:password@db_host:port/database"
     )
     pc.add_argument("--update", action="store_true", help="update all cluster mappings")
+    pc.add_argument(
+        "--min-concurrency",
+        type=int,
+        default=_MIN_CONCURRENCY,
+        metavar="N",
+        help="min. Cassandra queries in flight per worker"
+        f" (default {_MIN_CONCURRENCY})",
+    )
+    pc.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=_MAX_CONCURRENCY,
+        metavar="N",
+        help="max. Cassandra queries in flight per worker"
+        f" (default {_MAX_CONCURRENCY}); the number in between is adapted to"
+        " latency and timeouts",
+    )
+    pc.add_argument(
+        "--mapping-mode",
+        choices=["auto", "lookup", "scan"],
+        default="auto",
+        help="look up the addresses to map, or scan the address tables of the"
+        " keyspaces for them (not for ETH/TRX); auto scans if the addresses to"
+        " map are at least --scan-ratio of the keyspace addresses",
+    )
+    pc.add_argument(
+        "--scan-ratio",
+        type=float,
+        default=0.01,
+        metavar="RATIO",
+        help="ratio of addresses to map to keyspace addresses from which on"
+        " to scan in auto mode (default 0.01)",
+    )
+    pc.add_argument(
+        "--scan-splits",
+        type=int,
+        default=256,
+        metavar="N",
+        help="number of token ranges a keyspace is scanned in (default 256)",
+    )
+    pc.add_argument(
+        "--cache-file",
+        default=None,
+        metavar="PATH",
+        help="SQLite file caching address to cluster mappings across runs;"
+        " entries of a network are dropped when its transformed keyspace"
+        " changes",
+    )
+    pc.add_argument(
+        "--group-by-partition",
+        action="store_true",
+        help="look up addresses and clusters sharing a Cassandra partition"
+        " with one IN query instead of one query each",
+    )
+    pc.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the latest unfinished run: only map the addresses it"
+        " did not map yet or failed to map, and skip scanned token ranges",
+    )
     pc.set_defaults(func=insert_cluster_mapping, url=def_url)
 
     # refresh_views
@@ -1787,6 +2123,13 @@ def main():
         print_warn(url_msg)
         parser.error("No postgresql URL connection was provided. Exiting.")
 
+    if hasattr(args, "max_concurrency") and not (
+        1 <= args.min_concurrency <= args.max_concurrency
+    ):
+        parser.error(
+            "--min-concurrency must be at least 1 and at most --max-concurrency"
+        )
+
     return args.func(args)
 
 
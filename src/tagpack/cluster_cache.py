@@ -0,0 +1,103 @@
+"""On-disk cache of address to cluster mappings (SQLite).
+
+Entries are kept per network together with the transformed keyspace they
+were read from. When the keyspace configured for a network changes, its
+entries are dropped.
+"""
+
+import os
+import sqlite3
+from contextlib import contextmanager
+
+from pandas import DataFrame
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS keyspace (
+    network TEXT PRIMARY KEY,
+    keyspace TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cluster_mapping (
+    network TEXT NOT NULL,
+    address TEXT NOT NULL,
+    cluster_id INTEGER,
+    cluster_defining_address TEXT,
+    no_addresses INTEGER,
+    PRIMARY KEY (network, address)
+) WITHOUT ROWID;
+"""
+
+# stays below the default max. number of sqlite host parameters
+_MAX_PARAMS = 500
+
+
+class ClusterMappingCache:
+    COLUMNS = ["address", "cluster_id", "cluster_defining_address", "no_addresses"]
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # transactions are managed in _write, several (worker) processes can
+        # use the same file
+        self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+        self._keyspaces = {}
+
+    @contextmanager
+    def _write(self):
+        # take the write lock before reading, a deferred transaction can't be
+        # upgraded if another process wrote in between
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def use_keyspace(self, network: str, keyspace: str):
+        """Drops the entries of network if they were read from another
+        keyspace."""
+        if self._keyspaces.get(network, None) == keyspace:
+            return
+
+        with self._write():
+            row = self.conn.execute(
+                "SELECT keyspace FROM keyspace WHERE network = ?", (network,)
+            ).fetchone()
+            if row is None or row[0] != keyspace:
+                self.conn.execute(
+                    "DELETE FROM cluster_mapping WHERE network = ?", (network,)
+                )
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO keyspace VALUES (?, ?)", (network, keyspace)
+                )
+        self._keyspaces[network] = keyspace
+
+    def get(self, network: str, addresses: list) -> DataFrame:
+        """Cached mappings of addresses (missing ones are left out)."""
+        rows = []
+        for i in range(0, len(addresses), _MAX_PARAMS):
+            chunk = addresses[i : i + _MAX_PARAMS]
+            q = (
+                f"SELECT {', '.join(self.COLUMNS)} FROM cluster_mapping "
+                f"WHERE network = ? AND address IN ({', '.join('?' * len(chunk))})"
+            )
+            rows.extend(self.conn.execute(q, [network] + chunk).fetchall())
+        return DataFrame(rows, columns=self.COLUMNS)
+
+    def put(self, network: str, clusters: DataFrame):
+        """Stores the mappings of clusters (address, cluster_id,
+        cluster_defining_address and no_addresses columns)."""
+        records = zip(*(clusters[c].tolist() for c in self.COLUMNS))
+        with self._write():
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cluster_mapping VALUES (?, ?, ?, ?, ?)",
+                ((network, *r) for r in records),
+            )
+
+    def close(self):
+        self.conn.close()
@@ -1,17 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import functools
 import hashlib
-from typing import Optional
+import threading
+import time
+from collections import deque
+from typing import Iterable, List, Optional
 
 import base58
 import numpy as np
+from cassandra import OperationTimedOut, ReadTimeout, Unavailable
 from cassandra.auth import PlainTextAuthProvider
-from cassandra.cluster import Cluster
-from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.cluster import Cluster, NoHostAvailable
+from cassandra.protocol import IsBootstrappingErrorMessage, OverloadedErrorMessage
 from cassandra.query import dict_factory
 from pandas import DataFrame
 from pandas import pandas as pd
 
+from tagpack.cluster_cache import ClusterMappingCache
 from tagpack.cmd_utils import print_warn
 
 TRON_ADDRESS_PREFIX = b"\x41"
@@ -105,8 +111,17 @@ def strip_tron_prefix(address_bytes, prefix: bytes = TRON_ADDRESS_PREFIX):
     return address_bytes
 
 
+def _b58decode(v: str) -> bytes:
+    # same as base58.b58decode, but converts the decoded int to bytes in one go
+    v = v.rstrip()
+    stripped = v.lstrip("1")
+    acc = base58.b58decode_int(stripped)
+    pad = b"\0" * (len(v) - len(stripped))
+    return pad + acc.to_bytes((acc.bit_length() + 7) // 8, "big")
+
+
 def tron_address_to_evm(taddress_str: str, validate: bool = True) -> bytes:
-    ab = base58.b58decode(taddress_str)
+    ab = _b58decode(taddress_str)
     checkSum = ab[-4:]
     a = ab[:-4]
 
@@ -123,7 +138,487 @@ def tron_address_to_evm(taddress_str: str, validate: bool = True) -> bytes:
         raise ValueError(f"Invalid checksum on address {taddress_str}")
 
 
-_CONCURRENCY = 100
+_CONVERSION_CACHE_SIZE = 2**17
+
+
+@functools.lru_cache(maxsize=_CONVERSION_CACHE_SIZE)
+def _cached_tron_to_eth(x):
+    return try_convert_tron_to_eth(x)
+
+
+@functools.lru_cache(maxsize=_CONVERSION_CACHE_SIZE)
+def _cached_to_tron(x):
+    return try_convert_to_tron(x)
+
+
+def eth_addresses_from_hex(addresses: Iterable[str]) -> List[Optional[bytes]]:
+    """Batch version of eth_address_from_hex, None if not convertible."""
+    fromhex = bytes.fromhex
+    result = []
+    for address in addresses:
+        try:
+            # fromhex is case insensitive
+            result.append(fromhex(address[2:]))
+        except Exception as e:
+            print_warn(f"can't convert to hex {address}; {e}")
+            result.append(None)
+    return result
+
+
+def tron_addresses_to_eth(addresses: Iterable[str]) -> List[Optional[str]]:
+    """Batch version of try_convert_tron_to_eth (memoized)."""
+    return [_cached_tron_to_eth(x) for x in addresses]
+
+
+def evm_addresses_to_tron(
+    addresses: Iterable[bytes], known: Optional[dict] = None
+) -> List[Optional[str]]:
+    """Batch version of try_convert_to_tron (memoized).
+
+    Args:
+        addresses: binary evm addresses
+        known: evm address -> t-style address pairs already known
+            (e.g. from the inputs), these are not converted again
+    """
+    known = known or {}
+    return [known.get(x) or _cached_to_tron(x) for x in addresses]
+
+
+def address_lookup_parameters(
+    addresses: pd.Series, network: str, ks_config: dict
+) -> DataFrame:
+    """Builds the address_prefix and address columns to query
+    address_ids_by_address_prefix with. Addresses of eth like networks are
+    converted to bytes, addresses that can't be converted are dropped. The
+    index of addresses is kept."""
+    prefix_length = ks_config["address_prefix_length"]
+
+    if network == "TRX":
+        # convert t-style to evm, filter non convertible addresses
+        addresses = pd.Series(
+            tron_addresses_to_eth(addresses), index=addresses.index, dtype=object
+        )
+        addresses = addresses[addresses.notnull()]
+
+    if is_eth_like(network):
+        df = DataFrame(
+            {
+                "address_prefix": addresses.str[2 : 2 + prefix_length].str.upper(),
+                "address": pd.Series(
+                    eth_addresses_from_hex(addresses),
+                    index=addresses.index,
+                    dtype=object,
+                ),
+            }
+        )
+        # wrongly encoded addresses can't be converted, filter again
+        return df[df["address"].notnull()]
+
+    bech_32_prefix = ks_config.get("bech_32_prefix", None)
+    if bech_32_prefix:
+        stripped = addresses.str.replace(bech_32_prefix, "", regex=False)
+    else:
+        stripped = addresses
+    return DataFrame(
+        {"address_prefix": stripped.str[:prefix_length], "address": addresses}
+    )
+
+
+_MIN_CONCURRENCY = 8
+_MAX_CONCURRENCY = 512
+_INITIAL_CONCURRENCY = 100
+
+_MAX_RETRIES = 5
+_MAX_IN_SIZE = 100
+_RETRY_DELAY = 0.1
+
+# errors signalling an overloaded (or partially unavailable) cluster, queries
+# failing with them are retried
+_OVERLOAD_ERRORS = (
+    OperationTimedOut,
+    ReadTimeout,
+    Unavailable,
+    OverloadedErrorMessage,
+    IsBootstrappingErrorMessage,
+    NoHostAvailable,
+)
+
+_ADDRESS_ID_QUERY = (
+    "SELECT address, address_id "
+    + "FROM {keyspace}.address_ids_by_address_prefix "
+    + "WHERE address_prefix=? and address=?"
+)
+_CLUSTER_ID_QUERY = (
+    "SELECT address_id, cluster_id "
+    + "FROM {keyspace}.address WHERE address_id_group=? and address_id=?"
+)
+_CLUSTER_QUERY = (
+    "SELECT * FROM {keyspace}.cluster " + "WHERE cluster_id_group=? and cluster_id=?"
+)
+_CLUSTER_DEFINER_QUERY = (
+    "SELECT address_id as cluster_id, "
+    "address as cluster_defining_address FROM {keyspace}.address "
+    + "WHERE address_id_group=? and address_id=?"
+)
+_ADDRESS_SCAN_QUERY = (
+    "SELECT address, address_id, cluster_id FROM {keyspace}.address "
+    + "WHERE token(address_id_group) > ? AND token(address_id_group) <= ?"
+)
+
+# Murmur3Partitioner, the min token is never assigned to a partition
+_MIN_TOKEN = -(2**63)
+_MAX_TOKEN = 2**63 - 1
+
+
+def token_range_splits(n: int) -> list:
+    """Splits the token ring into n (first, last] ranges."""
+    step = (_MAX_TOKEN - _MIN_TOKEN) // n
+    bounds = [_MIN_TOKEN + i * step for i in range(n)] + [_MAX_TOKEN]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class AdaptiveConcurrency:
+    """AIMD limit for the number of queries in flight.
+
+    The limit grows by one per round trip (1 / limit per successful query)
+    while the window is used, and is cut by backoff on timeouts and overload
+    errors or when the smoothed latency exceeds latency_factor times the
+    baseline (a slowly rising minimum of the observed latencies). It is cut
+    at most once per window of limit completions.
+
+    Not thread safe, the query runners call it with their lock held.
+    """
+
+    def __init__(
+        self,
+        floor: int = _MIN_CONCURRENCY,
+        ceiling: int = _MAX_CONCURRENCY,
+        initial: int = _INITIAL_CONCURRENCY,
+        backoff: float = 0.5,
+        latency_factor: float = 2.0,
+    ):
+        if not 1 <= floor <= ceiling:
+            raise ValueError(f"Invalid concurrency range [{floor}, {ceiling}]")
+        self.floor = floor
+        self.ceiling = ceiling
+        self.backoff = backoff
+        self.latency_factor = latency_factor
+        self.limit = float(min(ceiling, max(floor, initial)))
+        self.baseline = None
+        self.latency = None
+        self._since_decrease = 0
+
+    @property
+    def current(self) -> int:
+        return int(self.limit)
+
+    def on_success(self, latency: float, in_flight: int):
+        self._since_decrease += 1
+        if self.baseline is None:
+            self.baseline = self.latency = latency
+        # the baseline drifts up slowly to follow a generally slower cluster
+        self.baseline = min(latency, self.baseline * 1.001)
+        self.latency = 0.9 * self.latency + 0.1 * latency
+
+        if self.latency > self.latency_factor * self.baseline:
+            self._decrease()
+        elif in_flight >= self.limit / 2:
+            self.limit = min(self.ceiling, self.limit + 1 / self.limit)
+
+    def on_overload(self):
+        self._since_decrease += 1
+        self._decrease()
+
+    def _decrease(self):
+        if self._since_decrease < self.limit:
+            return
+        self.limit = max(self.floor, self.limit * self.backoff)
+        self._since_decrease = 0
+
+
+def in_query(query: str) -> str:
+    """IN variant of a point query ending in 'key=?'."""
+    head, _ = query.rsplit("=?", 1)
+    return head + " IN ?"
+
+
+def partition_lookups(
+    kind: str, partitions, keys, grouped: bool, max_in_size: int = _MAX_IN_SIZE
+):
+    """Yields (kind, (partition, key), False) point lookups, or if grouped one
+    (kind, (partition, [keys]), True) IN lookup per partition (in chunks of
+    max_in_size). Partitions with a single key are looked up with a point
+    query anyway."""
+    if not grouped:
+        for partition, key in zip(partitions, keys):
+            yield kind, (partition, key), False
+        return
+
+    groups = {}
+    for partition, key in zip(partitions, keys):
+        groups.setdefault(partition, []).append(key)
+    for partition, group in groups.items():
+        for i in range(0, len(group), max_in_size):
+            yield _lookup(kind, partition, group[i : i + max_in_size])
+
+
+def _lookup(kind: str, partition, keys: list) -> tuple:
+    if len(keys) == 1:
+        return kind, (partition, keys[0]), False
+    return kind, (partition, keys), True
+
+
+class AsyncQueryRunner:
+    """Runs queries with execute_async, keeping concurrency.current queries in
+    flight. Queries failing with overload errors are retried (with a short,
+    growing delay) up to max_retries times, other errors fail the run.
+
+    Queries are (kind, parameters, grouped) tuples, kind selects the
+    statement, grouped the IN variant of it (see partition_lookups). Rows are
+    collected per kind in rows.
+    """
+
+    def __init__(
+        self,
+        session,
+        statements: dict,
+        concurrency: AdaptiveConcurrency,
+        in_statements: Optional[dict] = None,
+        max_retries: int = _MAX_RETRIES,
+        max_in_size: int = _MAX_IN_SIZE,
+    ):
+        """
+        Args:
+            session: cassandra session
+            statements: prepared (point) statements by kind
+            concurrency: limit for the queries in flight, shared between runs
+            in_statements: prepared IN statements by kind, if given follow-up
+                lookups are grouped by partition
+            max_retries: retries per query
+            max_in_size: max. keys per IN query
+        """
+        self._session = session
+        self._statements = statements
+        self._in_statements = in_statements or {}
+        self._group_by_partition = in_statements is not None
+        self._concurrency = concurrency
+        self._max_retries = max_retries
+        self._max_in_size = max_in_size
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._finished = threading.Event()
+        self._queries = iter(())
+        self._queries_exhausted = True
+        # (kind, partition, keys) in order, keys of a group grow while waiting
+        self._follow_ups = deque()
+        self._open_groups = {}
+        self._in_flight = 0
+        self._errors = []
+
+        self.retries = 0
+        self.rows = {kind: [] for kind in statements}
+
+    def run(self, queries):
+        """Executes all (kind, parameters, grouped) queries, blocks until
+        done.
+
+        Raises the exception of the first failed query, no new queries are
+        started after a failure.
+        """
+        with self._lock:
+            self._queries = iter(queries)
+            self._queries_exhausted = False
+            self._finished.clear()
+            submit = self._next_queries()
+        self._submit(submit)
+        self._finished.wait()
+
+        if self._errors:
+            raise self._errors[0]
+
+    def _handle_rows(self, kind: str, rows):
+        """Called with the lock held, may add follow-ups."""
+        self.rows[kind].extend(rows)
+
+    def _add_follow_up(self, kind: str, partition, key):
+        """Queues a lookup, grouped with the queued ones of the same
+        partition if grouping by partition."""
+        group = None
+        if self._group_by_partition:
+            group = self._open_groups.get((kind, partition), None)
+        if group is None or len(group) >= self._max_in_size:
+            group = []
+            self._follow_ups.append((kind, partition, group))
+            if self._group_by_partition:
+                self._open_groups[(kind, partition)] = group
+        group.append(key)
+
+    def _next_follow_up(self) -> tuple:
+        kind, partition, keys = self._follow_ups.popleft()
+        if self._open_groups.get((kind, partition), None) is keys:
+            del self._open_groups[(kind, partition)]
+        return _lookup(kind, partition, keys)
+
+    def _next_queries(self) -> list:
+        # call with lock held, returns the queries to submit (outside the lock,
+        # callbacks of already finished futures are run right away)
+        queries = []
+        while not self._errors and self._in_flight < self._concurrency.current:
+            if self._follow_ups:
+                kind, params, grouped = self._next_follow_up()
+            elif not self._queries_exhausted:
+                query = next(self._queries, None)
+                if query is None:
+                    self._queries_exhausted = True
+                    continue
+                kind, params, grouped = query
+            else:
+                break
+            queries.append((kind, params, grouped, 0))
+            self._in_flight += 1
+
+        if self._in_flight == 0 and not queries:
+            self._finished.set()
+        return queries
+
+    def _submit(self, queries: list):
+        # callbacks of futures that are already done run right away in this
+        # thread and submit again; queue those here instead of recursing
+        pending = getattr(self._local, "pending", None)
+        if pending is not None:
+            pending.extend(queries)
+            return
+
+        pending = self._local.pending = deque(queries)
+        try:
+            while pending:
+                query = pending.popleft()
+                kind, params, grouped, _ = query
+                statements = self._in_statements if grouped else self._statements
+                started = time.perf_counter()
+                try:
+                    future = self._session.execute_async(statements[kind], params)
+                except Exception as e:
+                    self._on_error(e, query)
+                    continue
+                future.add_callbacks(
+                    callback=self._on_rows,
+                    callback_args=(query, started),
+                    errback=self._on_error,
+                    errback_args=(query,),
+                )
+        finally:
+            self._local.pending = None
+
+    def _on_rows(self, rows, query: tuple, started: float):
+        with self._lock:
+            self._concurrency.on_success(time.perf_counter() - started, self._in_flight)
+            self._in_flight -= 1
+            self._handle_rows(query[0], rows)
+            submit = self._next_queries()
+        self._submit(submit)
+
+    def _on_error(self, exc, query: tuple):
+        kind, params, grouped, attempt = query
+        with self._lock:
+            if isinstance(exc, _OVERLOAD_ERRORS):
+                self._concurrency.on_overload()
+                if attempt < self._max_retries and not self._errors:
+                    # stays in flight until resubmitted
+                    self.retries += 1
+                    retry = (kind, params, grouped, attempt + 1)
+                    timer = threading.Timer(
+                        _RETRY_DELAY * 2**attempt, self._submit, args=([retry],)
+                    )
+                    timer.daemon = True
+                    timer.start()
+                    return
+
+            self._in_flight -= 1
+            self._errors.append(exc)
+            submit = self._next_queries()
+        self._submit(submit)
+
+
+class ClusterLookupPipeline(AsyncQueryRunner):
+    """Resolves addresses to address ids, cluster ids, clusters and cluster
+    defining addresses with async queries. Every address moves on to its next
+    lookup as soon as the previous one resolved, there is no barrier between
+    the stages. Cluster (and definer) lookups are done once per cluster id.
+
+    Follow-up lookups are preferred over new addresses, so results leave the
+    pipeline early. If grouping by partition, lookups of a partition that
+    queue up while the window is full are done with one IN query.
+    """
+
+    def __init__(
+        self,
+        session,
+        statements: dict,
+        bucket_size: int,
+        concurrency: AdaptiveConcurrency,
+        in_statements: Optional[dict] = None,
+        max_retries: int = _MAX_RETRIES,
+    ):
+        """
+        Args:
+            session: cassandra session (dict_factory rows)
+            statements: prepared statements for the kinds address_id,
+                cluster_id, cluster and cluster_definer
+            bucket_size: bucket size of the keyspace (id groups)
+            concurrency: limit for the queries in flight
+            in_statements: IN variants of statements to group by partition
+            max_retries: retries per query
+        """
+        super().__init__(session, statements, concurrency, in_statements, max_retries)
+        self._bucket_size = bucket_size
+        self._seen_cluster_ids = set()
+
+    @property
+    def address_ids(self) -> list:
+        return self.rows["address_id"]
+
+    @property
+    def cluster_ids(self) -> list:
+        return self.rows["cluster_id"]
+
+    @property
+    def clusters(self) -> list:
+        return self.rows["cluster"]
+
+    @property
+    def cluster_definers(self) -> list:
+        return self.rows["cluster_definer"]
+
+    def run(self, address_prefixes, addresses):
+        """Looks up all addresses (with their prefixes), blocks until done."""
+        super().run(
+            partition_lookups(
+                "address_id",
+                address_prefixes,
+                addresses,
+                self._group_by_partition,
+                self._max_in_size,
+            )
+        )
+
+    def _group(self, id_: int) -> int:
+        return id_ // self._bucket_size
+
+    def _handle_rows(self, kind: str, rows):
+        super()._handle_rows(kind, rows)
+        for row in rows:
+            if kind == "address_id":
+                address_id = row["address_id"]
+                self._add_follow_up("cluster_id", self._group(address_id), address_id)
+            elif kind == "cluster_id":
+                cluster_id = row["cluster_id"]
+                if cluster_id not in self._seen_cluster_ids:
+                    self._seen_cluster_ids.add(cluster_id)
+                    group = self._group(cluster_id)
+                    self._add_follow_up("cluster", group, cluster_id)
+                    self._add_follow_up("cluster_definer", group, cluster_id)
 
 
 class GraphSense(object):
@@ -133,9 +628,19 @@ class GraphSense(object):
         ks_map: dict,
         username: Optional[str] = None,
         password: Optional[str] = None,
+        min_concurrency: int = _MIN_CONCURRENCY,
+        max_concurrency: int = _MAX_CONCURRENCY,
+        group_by_partition: bool = False,
+        cache: Optional[ClusterMappingCache] = None,
     ):
         self.hosts = hosts
         self.ks_map = ks_map
+        # consulted before querying, closed with this instance
+        self.cache = cache
+        # one IN query per partition instead of one query per key
+        self.group_by_partition = group_by_partition
+        # learned limit of queries in flight, kept across batches
+        self.concurrency = AdaptiveConcurrency(min_concurrency, max_concurrency)
 
         auth_provider = None
         if username is not None:
@@ -145,26 +650,32 @@ class GraphSense(object):
         self.session = self.cluster.connect()
         self.session.row_factory = dict_factory
 
+        # per instance caches, keyspaces and their config do not change
+        # during a run
+        self._keyspaces = None
+        self._ks_configs = {}
+        self._prepared = {}
+
     def close(self):
+        if self.cache is not None:
+            self.cache.close()
         self.cluster.shutdown()
         print(f"Disconnected from {self.hosts}")
 
-    def _execute_query(self, statement, parameters):
-        """Generic query execution"""
-        results = execute_concurrent_with_args(
-            self.session, statement, parameters, concurrency=_CONCURRENCY
+    def _execute_lookup(self, keyspace: str, query: str, partitions, keys):
+        """Looks up keys (with their partitions) with the point query, grouped
+        by partition into IN queries if group_by_partition is set."""
+        statements = {"lookup": self._prepare(keyspace, query)}
+        in_statements = None
+        if self.group_by_partition:
+            in_statements = {"lookup": self._prepare(keyspace, in_query(query))}
+        runner = AsyncQueryRunner(
+            self.session, statements, self.concurrency, in_statements
         )
-
-        i = 0
-        all_results = []
-        for success, result in results:
-            if not success:
-                print("failed" + result)
-            else:
-                for row in result:
-                    i = i + 1
-                    all_results.append(row)
-        return pd.DataFrame.from_dict(all_results)
+        runner.run(
+            partition_lookups("lookup", partitions, keys, self.group_by_partition)
+        )
+        return pd.DataFrame.from_dict(runner.rows["lookup"])
 
     def contains_keyspace_mapping(self, network: str) -> bool:
         return network in self.ks_map
@@ -177,23 +688,32 @@ class GraphSense(object):
         if not self.contains_keyspace_mapping(network):
             raise Exception(f"Network {network} not in keyspace mapping")
 
+    def _prepare(self, keyspace: str, query: str):
+        """Prepares query (with {keyspace} as table prefix) once per keyspace."""
+        key = (keyspace, query)
+        if key not in self._prepared:
+            query = query.format(keyspace=keyspace)
+            self._prepared[key] = self.session.prepare(query)
+        return self._prepared[key]
+
     def _query_keyspace_config(self, keyspace: str) -> dict:
-        self.session.set_keyspace(keyspace)
-        query = "SELECT * FROM configuration"
-        result = self.session.execute(query)
-        return result[0]
+        if keyspace not in self._ks_configs:
+            query = f"SELECT * FROM {keyspace}.configuration"
+            result = self.session.execute(query)
+            self._ks_configs[keyspace] = result[0]
+        return self._ks_configs[keyspace]
+
+    def _get_keyspaces(self) -> set:
+        if self._keyspaces is None:
+            query = "SELECT keyspace_name FROM system_schema.keyspaces"
+            result = self.session.execute(query)
+            self._keyspaces = {row["keyspace_name"] for row in result}
+        return self._keyspaces
 
     def keyspace_for_network_exists(self, network: str) -> bool:
         if self.contains_keyspace_mapping(network):
-            for k, keyspace in self.ks_map[network].items():
-                query = "SELECT keyspace_name FROM system_schema.keyspaces"
-                result = self.session.execute(query)
-                keyspaces = [row["keyspace_name"] for row in result]
-
-                if keyspace not in keyspaces:
-                    return False
-
-            return True
+            keyspaces = self._get_keyspaces()
+            return all(ks in keyspaces for ks in self.ks_map[network].values())
         else:
             return False
 
@@ -203,72 +723,30 @@ class GraphSense(object):
 
         keyspace = self.ks_map[network]["transformed"]
         ks_config = self._query_keyspace_config(keyspace)
-        self.session.set_keyspace(keyspace)
-
-        df_temp = df[["address"]].copy()
-        df_temp = df_temp.drop_duplicates()
 
-        if network == "TRX":
-            # convert t-style to evm
-            df_temp["address"] = df_temp["address"].apply(try_convert_tron_to_eth)
+        addresses = df["address"].drop_duplicates().reset_index(drop=True)
+        df_temp = address_lookup_parameters(addresses, network, ks_config)
 
-            # filter non convertible addresses
-            df_temp = df_temp[df_temp["address"].notnull()]
-
-            df_temp["address_prefix"] = df_temp["address"].str[
-                2 : 2 + ks_config["address_prefix_length"]
-            ]
-            df_temp["address_prefix"] = df_temp["address_prefix"].apply(
-                lambda x: x.upper()
-            )
-            df_temp["address"] = df_temp["address"].apply(
-                lambda x: eth_address_from_hex(x)
-            )
-
-            # the last step can fail two, eg, wrongly encoded addresses
-            # so we filter again filter non convertible addresses
-            df_temp = df_temp[df_temp["address"].notnull()]
-
-        elif network == "ETH":
-            df_temp["address_prefix"] = df_temp["address"].str[
-                2 : 2 + ks_config["address_prefix_length"]
-            ]
-            df_temp["address_prefix"] = df_temp["address_prefix"].apply(
-                lambda x: x.upper()
-            )
-
-            df_temp["address"] = df["address"].apply(lambda x: eth_address_from_hex(x))
-
-            # the last step can fail two, eg, wrongly encoded addresses
-            # so we filter again filter non convertible addresses
-            df_temp = df_temp[df_temp["address"].notnull()]
-        else:
-            if "bech_32_prefix" in ks_config:
-                df_temp["a"] = df_temp["address"].apply(
-                    lambda x: x.replace(ks_config["bech_32_prefix"], "")
-                )
-
-            df_temp["address_prefix"] = df_temp["a"].str[
-                : ks_config["address_prefix_length"]
-            ]
-
-        query = (
-            "SELECT address, address_id "
-            + "FROM address_ids_by_address_prefix "
-            + "WHERE address_prefix=? and address=?"
+        result = self._execute_lookup(
+            keyspace,
+            _ADDRESS_ID_QUERY,
+            df_temp["address_prefix"].tolist(),
+            df_temp["address"].tolist(),
         )
 
-        statement = self.session.prepare(query)
-        parameters = df_temp[["address_prefix", "address"]].to_records(index=False)
-
-        result = self._execute_query(statement, parameters)
-
         if len(result) > 0:
             if network == "ETH":
-                result["address"] = result["address"].apply(eth_address_to_hex_str)
+                result["address"] = ["0x" + x.hex() for x in result["address"]]
             elif network == "TRX":
-                # convert evm to t-style address
-                result["address"] = result["address"].apply(try_convert_to_tron)
+                # convert evm to t-style address, t-style inputs are already
+                # in canonical form and are reused
+                inputs = addresses.loc[df_temp.index]
+                known = {
+                    evm: tron
+                    for evm, tron in zip(df_temp["address"], inputs)
+                    if not tron.startswith("0x")
+                }
+                result["address"] = evm_addresses_to_tron(result["address"], known)
 
         return result
 
@@ -281,7 +759,6 @@ class GraphSense(object):
 
         keyspace = self.ks_map[network]["transformed"]
         ks_config = self._query_keyspace_config(keyspace)
-        self.session.set_keyspace(keyspace)
 
         df_temp = df[["address_id"]].copy()
         df_temp = df_temp.drop_duplicates()
@@ -289,14 +766,12 @@ class GraphSense(object):
             df_temp["address_id"] / ks_config["bucket_size"]
         ).astype(int)
 
-        query = (
-            "SELECT address_id, cluster_id "
-            + "FROM address WHERE address_id_group=? and address_id=?"
+        return self._execute_lookup(
+            keyspace,
+            _CLUSTER_ID_QUERY,
+            df_temp["address_id_group"].tolist(),
+            df_temp["address_id"].tolist(),
         )
-        statement = self.session.prepare(query)
-        parameters = df_temp[["address_id_group", "address_id"]].to_records(index=False)
-
-        return self._execute_query(statement, parameters)
 
     def get_clusters(self, df: DataFrame, network: str) -> DataFrame:
         """Get clusters for all passed cluster ids"""
@@ -307,7 +782,6 @@ class GraphSense(object):
 
         keyspace = self.ks_map[network]["transformed"]
         ks_config = self._query_keyspace_config(keyspace)
-        self.session.set_keyspace(keyspace)
 
         df_temp = df[["cluster_id"]].copy()
         df_temp = df_temp.drop_duplicates()
@@ -315,16 +789,16 @@ class GraphSense(object):
             df_temp["cluster_id"] / ks_config["bucket_size"]
         ).astype(int)
 
-        query = "SELECT * FROM cluster " + "WHERE cluster_id_group=? and cluster_id=?"
-        statement = self.session.prepare(query)
-        parameters = df_temp[["cluster_id_group", "cluster_id"]].to_records(index=False)
-
-        return self._execute_query(statement, parameters)
+        return self._execute_lookup(
+            keyspace,
+            _CLUSTER_QUERY,
+            df_temp["cluster_id_group"].tolist(),
+            df_temp["cluster_id"].tolist(),
+        )
 
     def _get_cluster_definers(self, df: DataFrame, network: str) -> DataFrame:
         keyspace = self.ks_map[network]["transformed"]
         ks_config = self._query_keyspace_config(keyspace)
-        self.session.set_keyspace(keyspace)
 
         df_temp = df[["cluster_id"]].copy()
         df_temp.rename(columns={"cluster_id": "address_id"}, inplace=True)
@@ -333,19 +807,86 @@ class GraphSense(object):
             df_temp["address_id"] / ks_config["bucket_size"]
         ).astype(int)
 
-        query = (
-            "SELECT address_id as cluster_id, "
-            "address as cluster_defining_address FROM address "
-            + "WHERE address_id_group=? and address_id=?"
+        return self._execute_lookup(
+            keyspace,
+            _CLUSTER_DEFINER_QUERY,
+            df_temp["address_id_group"].tolist(),
+            df_temp["address_id"].tolist(),
         )
-        statement = self.session.prepare(query)
-        parameters = df_temp[["address_id_group", "address_id"]].to_records(index=False)
 
-        return self._execute_query(statement, parameters)
+    def get_address_count(self, network: str) -> Optional[int]:
+        """Number of addresses in the keyspace of network (from its summary
+        statistics), None if not available."""
+        keyspace = self.ks_map[network]["transformed"]
+        try:
+            result = self.session.execute(
+                f"SELECT no_addresses FROM {keyspace}.summary_statistics LIMIT 1"
+            )
+            rows = list(result)
+        except Exception as e:
+            print_warn(f"Can't read summary statistics of {keyspace}; {e}")
+            return None
+        return rows[0]["no_addresses"] if rows else None
+
+    def scan_addresses(
+        self, network: str, first_token: int, last_token: int, addresses
+    ) -> DataFrame:
+        """Scans the token range (first_token, last_token] of the address
+        table of network for addresses (anything supporting in, e.g. a
+        BloomFilter) and returns their address, address_id and cluster_id."""
+        if is_eth_like(network):
+            raise Exception(f"{network} does not have clusters")
+
+        keyspace = self.ks_map[network]["transformed"]
+        statement = self._prepare(keyspace, _ADDRESS_SCAN_QUERY)
+        # pages through the range, only matching rows are kept
+        rows = self.session.execute(statement, (first_token, last_token))
+        return DataFrame.from_dict([r for r in rows if r["address"] in addresses])
+
+    def get_clusters_of_address_ids(self, df: DataFrame, network: str) -> DataFrame:
+        """Adds the cluster (and its defining address) to address, address_id,
+        cluster_id rows; clusters are looked up once each."""
+        df_clusters = self.get_clusters(df, network)
+        if len(df_clusters) == 0:
+            return DataFrame()
+        df_cluster_definers = self._get_cluster_definers(df, network)
+
+        result = df.merge(df_clusters, on="cluster_id", how="left").merge(
+            df_cluster_definers, on="cluster_id", how="left"
+        )
+        self._cache_clusters(result, network)
+        return result
+
+    def _use_cache(self, network: str) -> bool:
+        if self.cache is None:
+            return False
+        self.cache.use_keyspace(network, self.ks_map[network]["transformed"])
+        return True
+
+    def _cache_clusters(self, clusters: DataFrame, network: str):
+        if len(clusters) > 0 and self._use_cache(network):
+            self.cache.put(network, clusters[clusters["cluster_id"].notnull()])
 
     def get_address_clusters(self, df: DataFrame, network: str) -> DataFrame:
         self._check_passed_params(df, network, "address")
 
+        if not self._use_cache(network):
+            return self._get_address_clusters(df, network)
+
+        cached = self.cache.get(network, df["address"].drop_duplicates().tolist())
+        missing = df[~df["address"].isin(cached["address"])]
+        if missing.empty:
+            return cached
+
+        result = self._get_address_clusters(missing, network)
+        if len(result) == 0:
+            return cached
+        self._cache_clusters(result, network)
+        if cached.empty:
+            return result
+        return pd.concat([cached, result], ignore_index=True)
+
+    def _get_address_clusters(self, df: DataFrame, network: str) -> DataFrame:
         addresses = df.copy()
 
         if network == "ETH":
@@ -359,29 +900,65 @@ class GraphSense(object):
             addresses.rename(columns={"address": "checksum_address"}, inplace=True)
             addresses.loc[:, "address"] = addresses["checksum_address"]
 
+        if not is_eth_like(network):
+            return self._get_clusters_of_addresses(addresses, network)
+
         df_address_ids = self.get_address_ids(addresses, network)
         if len(df_address_ids) == 0:
             return DataFrame()
 
-        if is_eth_like(network):
-            df_address_ids["cluster_id"] = df_address_ids["address_id"]
-            df_address_ids["no_addresses"] = 1
+        df_address_ids["cluster_id"] = df_address_ids["address_id"]
+        df_address_ids["no_addresses"] = 1
 
-            result = df_address_ids.merge(addresses, on="address")
+        result = df_address_ids.merge(addresses, on="address")
 
-            result.drop("address", axis="columns", inplace=True)
-            result.rename(columns={"checksum_address": "address"}, inplace=True)
-            result["cluster_defining_address"] = result["address"]
+        result.drop("address", axis="columns", inplace=True)
+        result.rename(columns={"checksum_address": "address"}, inplace=True)
+        result["cluster_defining_address"] = result["address"]
 
-            return result
+        return result
+
+    def _get_clusters_of_addresses(self, addresses: DataFrame, network: str):
+        """Address, cluster and cluster definer of addresses, looked up in one
+        pipeline (see ClusterLookupPipeline)."""
+        keyspace = self.ks_map[network]["transformed"]
+        ks_config = self._query_keyspace_config(keyspace)
+
+        unique_addresses = addresses["address"].drop_duplicates()
+        params = address_lookup_parameters(unique_addresses, network, ks_config)
+
+        queries = {
+            "address_id": _ADDRESS_ID_QUERY,
+            "cluster_id": _CLUSTER_ID_QUERY,
+            "cluster": _CLUSTER_QUERY,
+            "cluster_definer": _CLUSTER_DEFINER_QUERY,
+        }
+        statements = {k: self._prepare(keyspace, q) for k, q in queries.items()}
+        in_statements = None
+        if self.group_by_partition:
+            in_statements = {
+                k: self._prepare(keyspace, in_query(q)) for k, q in queries.items()
+            }
+        pipeline = ClusterLookupPipeline(
+            self.session,
+            statements,
+            ks_config["bucket_size"],
+            self.concurrency,
+            in_statements,
+        )
+        pipeline.run(params["address_prefix"].tolist(), params["address"].tolist())
+
+        df_address_ids = DataFrame.from_dict(pipeline.address_ids)
+        if len(df_address_ids) == 0:
+            return DataFrame()
 
-        df_cluster_ids = self.get_cluster_ids(df_address_ids, network)
+        df_cluster_ids = DataFrame.from_dict(pipeline.cluster_ids)
         if len(df_cluster_ids) == 0:
             return DataFrame()
 
-        df_cluster_definers = self._get_cluster_definers(df_cluster_ids, network)
+        df_cluster_definers = DataFrame.from_dict(pipeline.cluster_definers)
 
-        df_address_clusters = self.get_clusters(df_cluster_ids, network)
+        df_address_clusters = DataFrame.from_dict(pipeline.clusters)
         if len(df_address_clusters) == 0:
             return DataFrame()
 
@@ -20,6 +20,20 @@ from tagpack.utils import get_github_repo_url
 
 register_adapter(np.int64, AsIs)
 
+# keeps the denormalized cluster_tag table in sync, {where} restricts the tags
+_UPSERT_CLUSTER_TAGS_SQL = """
+    INSERT INTO cluster_tag
+        (tag_id, network, gs_cluster_id, acl_group, confidence_level)
+    SELECT t.id, t.network, acm.gs_cluster_id, tp.acl_group, c.level
+    FROM tag t
+    JOIN address_cluster_mapping acm
+        ON acm.address = t.identifier AND acm.network = t.network
+    JOIN tagpack tp ON tp.id = t.tagpack
+    JOIN confidence c ON c.id = t.confidence
+    {where}
+    ON CONFLICT (tag_id) DO UPDATE SET gs_cluster_id = EXCLUDED.gs_cluster_id
+"""
+
 
 class InsertTagpackWorker:
     def __init__(
@@ -77,6 +91,21 @@ class InsertTagpackWorker:
             return 0, 0
 
 
+def _addresses_to_map_sql(update_existing, run_id=None):
+    """Conditions (on the address table) and parameters selecting the
+    addresses to map: all or the unmapped ones, without those already mapped
+    or not found in run_id."""
+    where = "" if update_existing else " AND NOT is_mapped"
+    if run_id is None:
+        return where, ()
+    where += (
+        " AND NOT EXISTS (SELECT 1 FROM address_mapping_status s "
+        "WHERE s.network = address.network AND s.address = address.address "
+        "AND s.run_id = %s AND s.status <> 'failed')"
+    )
+    return where, (run_id,)
+
+
 def auto_commit(function):
     @wraps(function)
     def wrapper(*args, **kwargs):
@@ -133,6 +162,10 @@ class TagStore(object):
         self.existing_packs = None
         self.existing_actorpacks = None
 
+    def close(self):
+        self.cursor.close()
+        self.conn.close()
+
     def tp_exists(self, prefix, rel_path):
         if not self.existing_packs:
             self.existing_packs = self.get_ingested_tagpacks()
@@ -158,6 +191,11 @@ class TagStore(object):
 
         if force_insert:
             print(f"evicting and re-inserting tagpack {tagpack_id}")
+            self.cursor.execute(
+                "DELETE FROM tag_digest WHERE identifier IN "
+                "(SELECT identifier FROM tag WHERE tagpack = %s)",
+                (tagpack_id,),
+            )
             q = "DELETE FROM tagpack WHERE id = (%s)"
             self.cursor.execute(q, (tagpack_id,))
 
@@ -196,6 +234,11 @@ class TagStore(object):
                 page_size=batch,
             )
             execute_values(self.cursor, addr_sql, address_data, template="(%s, %s)")
+            self.cursor.execute(
+                _UPSERT_CLUSTER_TAGS_SQL.format(where="WHERE t.id = ANY(%s)"),
+                ([tag_id for (tag_id,) in new_ids],),
+            )
+            self.invalidate_tag_digests([t[2] for t in tag_data])
 
             assert len(tag_concepts) == len(new_ids)
             tcd = []
@@ -574,10 +617,20 @@ class TagStore(object):
                             t.tagpack = tp.id) as x
                     WHERE duplicate_count > 1
                 )
+                RETURNING identifier
             """
         )
+        rows_deleted = self.cursor.rowcount
+        self.invalidate_tag_digests({i for (i,) in self.cursor.fetchall()})
         self.conn.commit()
-        return self.cursor.rowcount
+        return rows_deleted
+
+    def invalidate_tag_digests(self, identifiers):
+        # stored digests of these identifiers are outdated, see
+        # gs-tagstore-cli materialize-tag-digests
+        self.cursor.execute(
+            "DELETE FROM tag_digest WHERE identifier = ANY(%s)", (list(identifiers),)
+        )
 
     @auto_commit
     def refresh_db(self):
@@ -587,6 +640,13 @@ class TagStore(object):
             "REFRESH MATERIALIZED VIEW CONCURRENTLY tag_count_by_cluster"
         )
         self.cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY best_cluster_tag")  # noqa
+        self.rebuild_cluster_tags()
+
+    @auto_commit
+    def rebuild_cluster_tags(self):
+        # delete instead of truncate, readers keep the old rows until commit
+        self.cursor.execute("DELETE FROM cluster_tag")
+        self.cursor.execute(_UPSERT_CLUSTER_TAGS_SQL.format(where=""))
 
     def get_addresses(self, update_existing):
         if update_existing:
@@ -597,6 +657,163 @@ class TagStore(object):
         for record in self.cursor:
             yield record
 
+    def get_address_key_ranges(self, network, update_existing, batch_size, run_id=None):
+        """Yields (first, last) address of consecutive batches of batch_size
+        addresses of network, read through a server side cursor so the
+        addresses are never held in memory at once. Close the generator if
+        it is not exhausted, the cursor is closed and its transaction ended
+        then."""
+        where, params = _addresses_to_map_sql(update_existing, run_id)
+        q = f"SELECT address FROM address WHERE network = %s{where} ORDER BY address"
+
+        try:
+            with self.conn.cursor(name=f"address_key_ranges_{network}") as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(q, (network, *params))
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows[0][0], rows[-1][0]
+        finally:
+            self.conn.commit()
+
+    @auto_commit
+    def get_addresses_count(self, network, update_existing, run_id=None) -> int:
+        where, params = _addresses_to_map_sql(update_existing, run_id)
+        q = f"SELECT count(*) FROM address WHERE network = %s{where}"
+        self.cursor.execute(q, (network, *params))
+        return self.cursor.fetchone()[0]
+
+    def iter_network_addresses(
+        self, network, update_existing, batch_size=10_000, run_id=None
+    ):
+        """Yields the addresses of network, read through a server side
+        cursor (see get_address_key_ranges)."""
+        where, params = _addresses_to_map_sql(update_existing, run_id)
+        q = f"SELECT address FROM address WHERE network = %s{where}"
+
+        try:
+            with self.conn.cursor(name=f"network_addresses_{network}") as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(q, (network, *params))
+                for (address,) in cursor:
+                    yield address
+        finally:
+            self.conn.commit()
+
+    @auto_commit
+    def filter_network_addresses(
+        self, network, addresses, update_existing, run_id=None
+    ) -> set:
+        """The addresses of network (to map) among addresses."""
+        where, params = _addresses_to_map_sql(update_existing, run_id)
+        q = (
+            "SELECT address FROM address "
+            f"WHERE network = %s AND address = ANY(%s){where}"
+        )
+        self.cursor.execute(q, (network, list(addresses), *params))
+        return {address for (address,) in self.cursor.fetchall()}
+
+    @auto_commit
+    def get_addresses_in_range(
+        self, network, first, last, update_existing, run_id=None
+    ):
+        where, params = _addresses_to_map_sql(update_existing, run_id)
+        q = (
+            "SELECT address, network FROM address "
+            f"WHERE network = %s AND address >= %s AND address <= %s{where}"
+        )
+        self.cursor.execute(q, (network, first, last, *params))
+        return self.cursor.fetchall()
+
+    @auto_commit
+    def start_mapping_run(self, update_existing) -> int:
+        self.cursor.execute(
+            "INSERT INTO cluster_mapping_run (update_existing) VALUES (%s) "
+            "RETURNING id",
+            (update_existing,),
+        )
+        return self.cursor.fetchone()[0]
+
+    @auto_commit
+    def get_unfinished_mapping_run(self):
+        """(id, update_existing) of the latest unfinished mapping run or None."""
+        self.cursor.execute(
+            "SELECT id, update_existing FROM cluster_mapping_run "
+            "WHERE finished IS NULL ORDER BY id DESC LIMIT 1"
+        )
+        return self.cursor.fetchone()
+
+    @auto_commit
+    def set_address_mapping_status(
+        self, run_id, network, addresses, status, error=None
+    ):
+        """Records status (mapped, not_found or failed) of addresses; attempts
+        count the tries within run_id."""
+        if len(addresses) == 0:
+            return
+        self.cursor.execute(
+            "INSERT INTO address_mapping_status "
+            "(network, address, run_id, status, attempts, error) "
+            "SELECT %s, a, %s, %s, 1, %s FROM unnest(%s::text[]) AS a "
+            "ON CONFLICT (network, address) DO UPDATE SET "
+            "status = EXCLUDED.status, error = EXCLUDED.error, lastmod = now(), "
+            "attempts = CASE WHEN address_mapping_status.run_id = EXCLUDED.run_id "
+            "THEN address_mapping_status.attempts + 1 ELSE 1 END, "
+            "run_id = EXCLUDED.run_id",
+            (network, run_id, status, error, list(dict.fromkeys(addresses))),
+        )
+
+    @auto_commit
+    def mark_unmapped_not_found(self, run_id, network, update_existing):
+        """Marks the addresses of network still to map in run_id as not found
+        (after a full scan of the network)."""
+        where, params = _addresses_to_map_sql(update_existing, run_id)
+        self.cursor.execute(
+            "INSERT INTO address_mapping_status "
+            "(network, address, run_id, status, attempts) "
+            "SELECT network, address, %s, 'not_found', 1 FROM address "
+            f"WHERE network = %s{where} "
+            "ON CONFLICT (network, address) DO UPDATE SET "
+            "status = EXCLUDED.status, error = NULL, lastmod = now(), "
+            "attempts = CASE WHEN address_mapping_status.run_id = EXCLUDED.run_id "
+            "THEN address_mapping_status.attempts + 1 ELSE 1 END, "
+            "run_id = EXCLUDED.run_id",
+            (run_id, network, *params),
+        )
+
+    @auto_commit
+    def add_mapping_checkpoint(self, run_id, network, first, last, status, mapped):
+        """Records a processed batch (address or token range) of a run."""
+        self.cursor.execute(
+            "INSERT INTO cluster_mapping_checkpoint "
+            "(run_id, network, first, last, status, nr_mapped) "
+            "VALUES (%s, %s, %s, %s, %s, %s) "
+            "ON CONFLICT (run_id, network, first, last) DO UPDATE SET "
+            "status = EXCLUDED.status, nr_mapped = EXCLUDED.nr_mapped, "
+            "lastmod = now()",
+            (run_id, network, str(first), str(last), status, mapped),
+        )
+
+    @auto_commit
+    def get_mapping_checkpoints(self, run_id, network) -> set:
+        """(first, last) of the successfully processed batches of network."""
+        self.cursor.execute(
+            "SELECT first, last FROM cluster_mapping_checkpoint "
+            "WHERE run_id = %s AND network = %s AND status = 'done'",
+            (run_id, network),
+        )
+        return set(self.cursor.fetchall())
+
+    @auto_commit
+    def delete_failed_mapping_checkpoints(self, run_id, network):
+        self.cursor.execute(
+            "DELETE FROM cluster_mapping_checkpoint "
+            "WHERE run_id = %s AND network = %s AND status = 'failed'",
+            (run_id, network),
+        )
+
     def get_tagstore_composition(self, by_network=False):
         if by_network:
             self.cursor.execute(
@@ -642,11 +859,46 @@ class TagStore(object):
 
             execute_batch(self.cursor, q, data)
 
+            self.cursor.execute(
+                _UPSERT_CLUSTER_TAGS_SQL.format(
+                    where="WHERE (t.identifier, t.network) IN "
+                    "(SELECT * FROM unnest(%s::text[], %s::text[]))"
+                ),
+                (list(clusters["address"]), list(clusters["network"])),
+            )
+
     @auto_commit
-    def finish_mappings_update(self, keys):
-        q = "UPDATE address SET is_mapped=true WHERE NOT is_mapped \
-                AND network IN %s"
-        self.cursor.execute(q, (tuple(keys),))
+    def finish_mappings_update(self, run_id, complete=True):
+        """Sets is_mapped for the addresses mapped (or not found) in run_id.
+        The run is closed if it is complete (no batches left to process) and
+        neither addresses nor batches failed. Returns the numbers of failed
+        addresses and failed batches."""
+        self.cursor.execute(
+            "UPDATE address a SET is_mapped = true "
+            "FROM address_mapping_status s "
+            "WHERE s.run_id = %s AND s.status IN ('mapped', 'not_found') "
+            "AND a.network = s.network AND a.address = s.address "
+            "AND NOT a.is_mapped",
+            (run_id,),
+        )
+        self.cursor.execute(
+            "SELECT count(*) FROM address_mapping_status "
+            "WHERE run_id = %s AND status = 'failed'",
+            (run_id,),
+        )
+        failed_addresses = self.cursor.fetchone()[0]
+        self.cursor.execute(
+            "SELECT count(*) FROM cluster_mapping_checkpoint "
+            "WHERE run_id = %s AND status = 'failed'",
+            (run_id,),
+        )
+        failed_batches = self.cursor.fetchone()[0]
+        if complete and failed_addresses == 0 and failed_batches == 0:
+            self.cursor.execute(
+                "UPDATE cluster_mapping_run SET finished = now() WHERE id = %s",
+                (run_id,),
+            )
+        return failed_addresses, failed_batches
 
     def get_ingested_tagpacks(self) -> List:
         self.cursor.execute("SELECT id from tagpack")
@@ -779,7 +1031,9 @@ class TagStore(object):
                 f"SELECT {'DISTINCT' if unique else ''} "
                 "t.network, tp.title, t.label "
                 "FROM tagpack tp, tag t WHERE t.tagpack = tp.id "
-                "AND EXISTS (Select tag_concept.concept_id from tag_concept where tag_concept.tag_id = t.id and tag_concept.concept_id ILIKE %s) AND t.network LIKE %s "
+                "AND EXISTS (Select tag_concept.concept_id from tag_concept "
+                "where tag_concept.tag_id = t.id "
+                "and tag_concept.concept_id ILIKE %s) AND t.network LIKE %s "
                 "ORDER BY t.network, tp.title, t.label ASC"
             )
             v = (category, network)
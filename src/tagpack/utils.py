@@ -1,3 +1,5 @@
+import hashlib
+import math
 import re
 import sys
 
@@ -130,3 +132,30 @@ def normalize_protocol_name(name):
     regex = re.compile("[^a-zA-Z0-9]")
     # First parameter is the replacement, second parameter is your input string
     return regex.sub("", name).lower()
+
+
+class BloomFilter:
+    """Set membership test with false positives (about error_rate once
+    capacity items are added) in a fraction of the memory of a set."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(1, capacity)
+        self.nbits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nhashes = max(1, round(self.nbits / capacity * math.log(2)))
+        self._bits = bytearray((self.nbits + 7) // 8)
+
+    def _indexes(self, item):
+        if isinstance(item, str):
+            item = item.encode("utf-8")
+        h = hashlib.blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(h[:8], "little")
+        h2 = int.from_bytes(h[8:], "little") | 1
+        return [(h1 + i * h2) % self.nbits for i in range(self.nhashes)]
+
+    def add(self, item):
+        for i in self._indexes(item):
+            self._bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, item) -> bool:
+        bits = self._bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(item))
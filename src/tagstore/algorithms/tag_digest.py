@@ -1,6 +1,6 @@
 import re
 from collections import Counter, defaultdict
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from pydantic import BaseModel
 
@@ -8,6 +8,9 @@ from ..db import InheritedFrom, TagPublic
 
 _FILTER_WORDS = dict.fromkeys(["to", "in", "the", "by", "of", "at", "", "vault"], True)
 
+_NON_WORD_CHARS = re.compile(r"[^0-9a-zA-Z_ ]+")
+_MULTI_SPACES = re.compile(" +")
+
 
 class LabelDigest(BaseModel):
     label: str
@@ -36,14 +39,20 @@ class TagDigest(BaseModel):
     concept_tag_cloud: Dict[str, TagCloudEntry]
 
 
+class SubjectTagDigest(BaseModel):
+    subject_id: str
+    network: Optional[str]
+    digest: TagDigest
+
+
 class wCounter:
     def __init__(self):
         self.wctr = Counter()
         self.ctr = Counter()
 
     def add(self, item, weight=1):
-        self.ctr.update({item: 1})
-        self.wctr.update({item: weight})
+        self.ctr[item] += 1
+        self.wctr[item] += weight
 
     def update(self, items):
         self.ctr.update(items)
@@ -53,7 +62,7 @@ class wCounter:
         return self.wctr if weighted else self.ctr
 
     def get_total(self, weighted=False):
-        return sum(dict(self.getcntr(weighted)).values())
+        return sum(self.getcntr(weighted).values())
 
     def get(self, item, weighted=False):
         return self.getcntr(weighted)[item]
@@ -73,11 +82,45 @@ def _map_concept_to_broad_concept(concept: str) -> str:
 
 
 def _remove_mulit_spaces(istr: str) -> str:
-    return re.sub(" +", " ", istr)
+    return _MULTI_SPACES.sub(" ", istr)
 
 
 def _normalizeWord(istr: str) -> str:
-    return _remove_mulit_spaces(re.sub(r"[^0-9a-zA-Z_ ]+", " ", istr.strip().lower()))
+    return _remove_mulit_spaces(_NON_WORD_CHARS.sub(" ", istr.strip().lower()))
+
+
+def _tokenize_label(label: str) -> Tuple[str, List[str]]:
+    """Normalized label and its words without filter words.
+
+    A normalized label only contains [0-9a-z_ ], so its words are already
+    normalized.
+    """
+    nlabel = _normalizeWord(label)
+    return nlabel, [w for w in nlabel.split(" ") if w not in _FILTER_WORDS]
+
+
+def _frequent_words_in(
+    labels: Iterable[str], word_counts: Dict[str, int]
+) -> Dict[str, int]:
+    """Sum of the occurrences of all words occurring more than once that
+    are contained (as substring) in each label.
+
+    Instead of testing every word against every label, all substrings of a
+    label with the length of a frequent word are looked up in a dict.
+    """
+    frequent = {w: c for w, c in word_counts.items() if c > 1}
+    lengths = {len(w) for w in frequent}
+
+    res = {}
+    for lbl in labels:
+        found = {
+            lbl[i : i + n]
+            for n in lengths
+            for i in range(len(lbl) - n + 1)
+            if lbl[i : i + n] in frequent
+        }
+        res[lbl] = sum(frequent[w] for w in found)
+    return res
 
 
 def _get_concept_weight(c: str) -> float:
@@ -123,6 +166,8 @@ def compute_tag_digest(tags: List[TagPublic]) -> TagDigest:
         }
     )
 
+    tokenized = {}
+
     def add_tag_data(t, tags_count: int, total_words: int, tags_count_cluster: int):
         if not _skipTag(t):
             conf = t.confidence_level or 0.1
@@ -132,16 +177,17 @@ def compute_tag_digest(tags: List[TagPublic]) -> TagDigest:
             if t.inherited_from == InheritedFrom.CLUSTER:
                 tags_count_cluster += 1
 
-            # compute words
-            norm_words = [_normalizeWord(w) for w in _normalizeWord(t.label).split(" ")]
-            filtered_words = [w for w in norm_words if w not in _FILTER_WORDS]
+            # compute words, once per distinct label
+            tokens = tokenized.get(t.label, None)
+            if tokens is None:
+                tokens = tokenized[t.label] = _tokenize_label(t.label)
+            nlabel, filtered_words = tokens
             total_words += len(filtered_words)
 
             # add words
-            label_word_counter.update(Counter(filtered_words))
+            label_word_counter.update(filtered_words)
 
             # add labels
-            nlabel = _normalizeWord(t.label)
             ls = label_summary[nlabel]
             full_label_counter.add(nlabel, conf)
 
@@ -182,14 +228,11 @@ def compute_tag_digest(tags: List[TagPublic]) -> TagDigest:
     # create a relevance score, prefer items where similar labels exist.
     sw_full_label_counter = wCounter()
     data = full_label_counter.most_common(weighted=True)
+    multipliers = _frequent_words_in(
+        (lbl for lbl, _ in data), label_word_counter.getcntr()
+    )
     for lbl, v in data:
-        multiplier = sum(
-            [
-                occurrence
-                for word, occurrence in label_word_counter.most_common()
-                if word in lbl and occurrence > 1
-            ]
-        )
+        multiplier = multipliers[lbl]
         n = 1 + multiplier / total_words if total_words > 0 else 1
         sw_full_label_counter.add(lbl, v * n)
 
@@ -240,3 +283,7 @@ def compute_tag_digest(tags: List[TagPublic]) -> TagDigest:
         concept_tag_cloud=_calcTagCloud(concepts_counter),
         label_digest=label_digest,
     )
+
+
+def compute_tag_digests(tags_by_subject: List[List[TagPublic]]) -> List[TagDigest]:
+    return [compute_tag_digest(tags) for tags in tags_by_subject]
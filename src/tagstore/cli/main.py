@@ -1,10 +1,13 @@
-from typing import Optional
+import asyncio
+from typing import List, Optional
 
 import typer
 
 from tagpack import __version__
 
+from ..algorithms.tag_digest import compute_tag_digests
 from ..config import TagstoreSettings
+from ..db import TagstoreDbAsync
 from ..db.database import (
     get_db_engine,
     get_table_ddl_sql,
@@ -15,6 +18,40 @@ from ..db.database import (
 app = typer.Typer()
 
 
+async def materialize_tag_digests(
+    db: TagstoreDbAsync,
+    groups: List[str],
+    only_missing: bool = True,
+    batch_size: int = 500,
+) -> int:
+    """Computes and stores the digests of identifiers with tags in groups.
+
+    Digests are stored per set of groups and served by the tag-digest
+    endpoint if the requested groups match exactly. With only_missing just
+    identifiers without a stored digest are processed (e.g. new identifiers
+    or those touched by tag inserts since the last run).
+
+    Returns:
+        int: number of digests computed
+    """
+    identifiers = await db.get_identifiers_for_tag_digests(
+        groups, only_missing=only_missing
+    )
+    for i in range(0, len(identifiers), batch_size):
+        results = await db.get_tags_by_subjectids(
+            [(x, None) for x in identifiers[i : i + batch_size]], None, groups
+        )
+        digests = compute_tag_digests([r.tags for r in results])
+        await db.store_tag_digests(
+            groups,
+            [
+                (r.subject_id, len(r.tags), d.model_dump_json())
+                for r, d in zip(results, digests)
+            ],
+        )
+    return len(identifiers)
+
+
 @app.command("version")
 def version():
     print(__version__)
@@ -33,6 +70,31 @@ def get_ddl():
     print(get_views_ddl_sql())
 
 
+@app.command("materialize-tag-digests")
+def materialize_digests(
+    groups: List[str] = ["public"],
+    full: bool = False,
+    batch_size: int = 500,
+    db_url: Optional[str] = None,
+):
+    """Precomputes tag digests, for every --groups value (a comma separated
+    set of acl groups). Without --full only identifiers without a stored
+    digest are processed. Needs an async (postgresql+asyncpg) db url."""
+
+    async def run():
+        db = TagstoreDbAsync.from_url(db_url or TagstoreSettings().db_url)
+        try:
+            for g in groups:
+                nr = await materialize_tag_digests(
+                    db, g.split(","), only_missing=not full, batch_size=batch_size
+                )
+                print(f"Materialized {nr} tag digests for groups {g}")
+        finally:
+            await db.engine.dispose()
+
+    asyncio.run(run())
+
+
 def main():
     # Deprecation warning
     import sys
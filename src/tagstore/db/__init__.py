@@ -1,11 +1,17 @@
 # flake8: noqa: E401
+from .cache import ResponseCache as ResponseCache
+from .cache import SingleFlight as SingleFlight
 from .database import get_db_engine_async as get_db_engine_async
 from .errors import TagAlreadyExistsException as TagAlreadyExistsException
 from .queries import ActorPublic as ActorPublic
 from .queries import InheritedFrom as InheritedFrom
 from .queries import LabelSearchResultPublic as LabelSearchResultPublic
 from .queries import NetworkStatisticsPublic as NetworkStatisticsPublic
+from .queries import TagExportPublic as TagExportPublic
 from .queries import TagPublic as TagPublic
+from .queries import TagsBySubjectPublic as TagsBySubjectPublic
+from .queries import TagsCursor as TagsCursor
+from .queries import TagsPagePublic as TagsPagePublic
 from .queries import TagstoreDbAsync as TagstoreDbAsync
 from .queries import TagstoreStatisticsPublic as TagstoreStatisticsPublic
 from .queries import Taxonomies as Taxonomies
@@ -0,0 +1,119 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+from ..metrics import CACHE_HITS, CACHE_MISSES, COALESCED_CALLS
+
+
+class ResponseCache:
+    """In-process LRU cache with a time to live for serialized responses.
+
+    Entries are stored as pre-serialized JSON bytes so cached responses
+    can be served without rebuilding and re-validating the pydantic models.
+
+    Only writes through the same process invalidate entries; changes made by
+    other processes (e.g. tagpack ingests) show after at most ttl seconds.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 300,
+        max_entries: int = 128,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        entry = self._entries.get(key, None)
+        if entry is not None:
+            expires, value = entry
+            if expires > self._clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                CACHE_HITS.inc()
+                return value
+            del self._entries[key]
+
+        self.misses += 1
+        CACHE_MISSES.inc()
+        return None
+
+    def set(self, key: Hashable, value: bytes):
+        self._entries[key] = (self._clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, namespace: Optional[str] = None):
+        """Drops all entries, or only those whose key starts with namespace.
+
+        Keys are tuples whose first item is the namespace (usually the name
+        of the cached TagstoreDbAsync method).
+        """
+        if namespace is None:
+            self._entries.clear()
+        else:
+            for key in [k for k in self._entries if k[0] == namespace]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total > 0 else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SingleFlight:
+    """Coalesces concurrent identical calls: while a call for a key is in
+    flight, further callers with the same key await its result instead of
+    doing the same work again.
+
+    Results are shared between the callers and must not be mutated.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        task = self._in_flight.get(key, None)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.coalesced += 1
+            COALESCED_CALLS.inc()
+
+        # a cancelled caller (e.g. client gone) must not cancel the others
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._in_flight.get(key, None) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            # mark as retrieved, the callers (if any are left) get it as well
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._in_flight),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+        }
@@ -1,3 +1,4 @@
+import asyncio
 import contextlib
 import sys
 from datetime import datetime
@@ -22,12 +23,17 @@ from .models import (
     ActorPack,
     Address,
     AddressClusterMapping,
+    AddressMappingStatus,
+    ClusterMappingCheckpoint,
+    ClusterMappingRun,
+    ClusterTag,
     Concept,
     ConceptRelationAnnotation,
     Confidence,
     Country,
     Tag,
     TagConcept,
+    TagDigestMaterialized,
     TagPack,
     TagSubject,
     TagType,
@@ -50,7 +56,12 @@ _MAIN_TABLES = [
     ActorJurisdiction.__table__,
     Address.__table__,
     AddressClusterMapping.__table__,
+    ClusterTag.__table__,
     ConceptRelationAnnotation.__table__,
+    TagDigestMaterialized.__table__,
+    ClusterMappingRun.__table__,
+    ClusterMappingCheckpoint.__table__,
+    AddressMappingStatus.__table__,
 ]
 
 
@@ -62,6 +73,50 @@ def get_db_engine_async(db_url, **kwargs):
     return create_async_engine(db_url, **kwargs)
 
 
+def get_db_engine_async_from_settings(settings):
+    """Async engine with the pool and asyncpg options of TagstoreSettings."""
+    connect_args = {"prepared_statement_cache_size": settings.db_statement_cache_size}
+    if settings.db_statement_timeout is not None:
+        connect_args["server_settings"] = {
+            "statement_timeout": str(settings.db_statement_timeout)
+        }
+
+    return get_db_engine_async(
+        settings.db_url,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=True,
+        connect_args=connect_args,
+    )
+
+
+async def prewarm_pool(engine, nr_connections: int):
+    """Opens nr_connections connections at once and returns them to the pool,
+    so the first requests do not pay for connection setup."""
+    connections = await asyncio.gather(
+        *[engine.connect() for _ in range(nr_connections)]
+    )
+    await asyncio.gather(*[c.close() for c in connections])
+
+
+def get_pool_stats(engine) -> dict:
+    pool = engine.sync_engine.pool
+    size = pool.size()
+    checked_out = pool.checkedout()
+    max_overflow = getattr(pool, "_max_overflow", 0)
+    capacity = size + max(max_overflow, 0)
+    return {
+        "size": size,
+        "max_overflow": max_overflow,
+        "checked_in": pool.checkedin(),
+        "checked_out": checked_out,
+        "overflow": pool.overflow(),
+        "saturation": checked_out / capacity if capacity > 0 else 0.0,
+    }
+
+
 def get_table_ddl_sql():
     out = []
 
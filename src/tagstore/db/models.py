@@ -269,6 +269,92 @@ class AddressClusterMapping(SQLModel, table=True):
     gs_cluster_no_addr: Optional[int]
 
 
+class ClusterTag(SQLModel, table=True):
+    """Tags by the cluster of their address, denormalized to serve cluster
+    based lookups without joining address_cluster_mapping at query time.
+
+    Maintained on tag and cluster mapping inserts, rebuilt on refresh_views.
+    """
+
+    __tablename__ = "cluster_tag"
+    __table_args__ = (
+        Index("cluster_tag_cluster_index", "gs_cluster_id", "network"),
+        _SHARED_TABLE_ARGS,
+    )
+    tag_id: int = Field(foreign_key="tag.id", primary_key=True, ondelete="CASCADE")
+    network: str
+    gs_cluster_id: int
+    acl_group: str
+    confidence_level: int
+
+
+class TagDigestMaterialized(SQLModel, table=True):
+    """Precomputed tag digests (serialized json) per identifier and set of
+    acl groups (sorted, comma separated).
+
+    Rows of identifiers touched by tag inserts are deleted, missing digests
+    are recomputed by the materialize-tag-digests command.
+    """
+
+    __tablename__ = "tag_digest"
+    __table_args__ = _SHARED_TABLE_ARGS
+    identifier: str = Field(primary_key=True)
+    acl_groups: str = Field(primary_key=True)
+    nr_tags: int
+    digest: str
+    lastmod: datetime = Field(sa_column_kwargs={"server_default": func.now()})
+
+
+class ClusterMappingRun(SQLModel, table=True):
+    """A run of the cluster mapping (insert_cluster_mapping), finished once
+    no address of the run failed."""
+
+    __tablename__ = "cluster_mapping_run"
+    __table_args__ = _SHARED_TABLE_ARGS
+    id: Optional[int] = Field(default=None, primary_key=True)
+    update_existing: bool
+    started: datetime = Field(sa_column_kwargs={"server_default": func.now()})
+    finished: Optional[datetime]
+
+
+class ClusterMappingCheckpoint(SQLModel, table=True):
+    """Processed batches of a mapping run per network, an address range
+    (lookup mode) or a token range (scan mode) with status done or failed.
+
+    Done batches are skipped when the run is resumed.
+    """
+
+    __tablename__ = "cluster_mapping_checkpoint"
+    __table_args__ = _SHARED_TABLE_ARGS
+    run_id: int = Field(
+        foreign_key="cluster_mapping_run.id", primary_key=True, ondelete="CASCADE"
+    )
+    network: str = Field(primary_key=True)
+    first: str = Field(primary_key=True)
+    last: str = Field(primary_key=True)
+    status: str
+    nr_mapped: int
+    lastmod: datetime = Field(sa_column_kwargs={"server_default": func.now()})
+
+
+class AddressMappingStatus(SQLModel, table=True):
+    """Outcome of the last mapping attempt of an address (mapped, not_found
+    or failed) and the number of attempts within that run."""
+
+    __tablename__ = "address_mapping_status"
+    __table_args__ = (
+        Index("ams_run_status_index", "run_id", "status"),
+        _SHARED_TABLE_ARGS,
+    )
+    network: str = Field(primary_key=True)
+    address: str = Field(primary_key=True)
+    run_id: int = Field(foreign_key="cluster_mapping_run.id", ondelete="CASCADE")
+    status: str
+    attempts: int
+    error: Optional[str]
+    lastmod: datetime = Field(sa_column_kwargs={"server_default": func.now()})
+
+
 # Materialized views only to make access uniform
 
 
@@ -1,31 +1,51 @@
+import base64
+import binascii
 import json
 import logging
+import time
 import uuid
 from datetime import timezone
 from enum import IntEnum
 from functools import wraps
 from json import JSONDecodeError
-from typing import Dict, List, Optional, Set
+from typing import AsyncIterator, Dict, Hashable, List, Optional, Set, Tuple
 
 from pydantic import BaseModel, computed_field
-from sqlalchemy import asc, desc, distinct, func
+from sqlalchemy import (
+    Integer,
+    String,
+    and_,
+    asc,
+    column,
+    delete,
+    desc,
+    distinct,
+    func,
+    or_,
+)
+from sqlalchemy import values as sa_values
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Row
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import joinedload
 from sqlmodel import select, text
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from ..metrics import DB_CALL_DURATION
+from .cache import ResponseCache, SingleFlight
 from .database import get_db_engine_async
 from .errors import TagAlreadyExistsException
 from .models import (
     Actor,
     AddressClusterMapping,
     BestClusterTagView,
+    ClusterTag,
     Concept,
     Confidence,
     Country,
     Tag,
     TagConcept,
-    TagCountByClusterView,
+    TagDigestMaterialized,
     TagPack,
     TagSubject,
     TagType,
@@ -241,6 +261,55 @@ class TagPublic(BaseModel):
             tagpack_uri=tp.uri,
         )
 
+    @classmethod
+    def fromDBRow(cls, r, inherited_from=None) -> "TagPublic":
+        """Builds a TagPublic from a plain row of _get_tag_rows_by_ids_stmt.
+
+        The row comes straight from the database, so validation is skipped.
+        """
+        concepts = r.concepts or []
+        return cls.model_construct(
+            identifier=r.identifier,
+            label=r.label,
+            source=r.source or "unknown",
+            creator=r.creator,
+            confidence=r.confidence,
+            confidence_level=r.confidence_level,
+            tag_subject=r.tag_subject,
+            tag_type=r.tag_type,
+            actor=r.actor,
+            primary_concept=r.primary_concept,
+            additional_concepts=[c for c in concepts if c != r.primary_concept],
+            is_cluster_definer=r.is_cluster_definer,
+            network=r.network,
+            lastmod=int(round(r.lastmod.replace(tzinfo=timezone.utc).timestamp())),
+            group=r.group,
+            inherited_from=inherited_from,
+            tagpack_title=r.tagpack_title,
+            tagpack_uri=r.tagpack_uri,
+        )
+
+
+class TagExportPublic(TagPublic):
+    id: int  # noqa
+
+    @classmethod
+    def fromDBRow(cls, r, inherited_from=None) -> "TagExportPublic":
+        t = super().fromDBRow(r, inherited_from=inherited_from)
+        t.id = r.id
+        return t
+
+
+class TagsPagePublic(BaseModel):
+    tags: List[TagPublic]
+    next_page: Optional[str]
+
+
+class TagsBySubjectPublic(BaseModel):
+    subject_id: str
+    network: Optional[str]
+    tags: List[TagPublic]
+
 
 class UserReportedAddressTag(BaseModel):
     address: str
@@ -251,43 +320,210 @@ class UserReportedAddressTag(BaseModel):
     user: Optional[str] = None
 
 
+class TagsCursor(BaseModel):
+    """Position in a tag listing ordered by (confidence level desc, tag id).
+
+    Serialized to an opaque token handed out as next_page to clients.
+    """
+
+    level: int
+    tag_id: int
+
+    def encode(self) -> str:
+        return (
+            base64.urlsafe_b64encode(f"{self.level}:{self.tag_id}".encode("utf-8"))
+            .decode("ascii")
+            .rstrip("=")
+        )
+
+    @classmethod
+    def decode(cls, token: str) -> "TagsCursor":
+        try:
+            padded = token + "=" * (-len(token) % 4)
+            level, tag_id = (
+                base64.urlsafe_b64decode(padded.encode("ascii"))
+                .decode("utf-8")
+                .split(":")
+            )
+            return cls(level=int(level), tag_id=int(tag_id))
+        except (binascii.Error, UnicodeError, ValueError) as e:
+            raise ValueError(f"Invalid page token {token}") from e
+
+
 # Statements
 
 
-def _get_tags_by_subjectid_stmt(
+def _tags_order(level=Confidence.level, tag_id=Tag.id):
+    return (desc(level), asc(tag_id))
+
+
+def _after_cursor(
+    q, cursor: Optional[TagsCursor], level=Confidence.level, tag_id=Tag.id
+):
+    if cursor is None:
+        return q
+    return q.where(
+        or_(
+            level < cursor.level,
+            and_(level == cursor.level, tag_id > cursor.tag_id),
+        )
+    )
+
+
+def _select_tag_rows():
+    """Plain tag columns (concepts aggregated into an array) instead of ORM
+    entities, which is considerably cheaper to build TagPublic objects from.
+    """
+    primary_concept = (
+        select(TagConcept.concept_id)
+        .where(TagConcept.tag_id == Tag.id)
+        .where(TagConcept.concept_relation_annotation_id == "primary")
+        .order_by(TagConcept.concept_id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    concepts = (
+        select(
+            func.array_agg(
+                aggregate_order_by(TagConcept.concept_id, TagConcept.concept_id)
+            )
+        )
+        .where(TagConcept.tag_id == Tag.id)
+        .scalar_subquery()
+    )
+    return (
+        select(
+            Tag.id.label("id"),
+            Tag.identifier.label("identifier"),
+            Tag.label.label("label"),
+            Tag.source.label("source"),
+            TagPack.creator.label("creator"),
+            Tag.confidence_id.label("confidence"),
+            Confidence.level.label("confidence_level"),
+            Tag.tag_subject_id.label("tag_subject"),
+            Tag.tag_type_id.label("tag_type"),
+            Tag.actor_id.label("actor"),
+            Tag.is_cluster_definer.label("is_cluster_definer"),
+            Tag.network.label("network"),
+            Tag.lastmod.label("lastmod"),
+            TagPack.acl_group.label("group"),
+            TagPack.title.label("tagpack_title"),
+            TagPack.uri.label("tagpack_uri"),
+            primary_concept.label("primary_concept"),
+            concepts.label("concepts"),
+        )
+        .where(Tag.tagpack_id == TagPack.id)
+        .where(Confidence.id == Tag.confidence_id)
+    )
+
+
+def _get_tag_rows_by_ids_stmt(tag_ids: List[int]):
+    """Loads a page of tags selected by one of the tag id statements below.
+
+    Tag ids are paged first without touching the concepts, so limit and
+    offset apply to tags and not to tag x concept rows.
+    """
+    return _select_tag_rows().where(Tag.id.in_(tag_ids))
+
+
+def _get_tag_rows_for_export_stmt(
+    groups: List[str],
+    network: Optional[str],
+    actor: Optional[str],
+    after_id: Optional[int],
+):
+    q = _select_tag_rows().where(TagPack.acl_group.in_(groups)).order_by(asc(Tag.id))
+
+    if network is not None:
+        q = q.where(Tag.network == network)
+    if actor is not None:
+        q = q.where(Tag.actor_id == actor)
+    if after_id is not None:
+        q = q.where(Tag.id > after_id)
+    return q
+
+
+def _get_tag_ids_by_subjectid_stmt(
     identifier: str,
     offset: Optional[int],
     page_size: Optional[int],
     groups: List[str],
     network: Optional[str],
+    cursor: Optional[TagsCursor] = None,
 ):
     q = (
-        select(Tag, TagPack, Confidence)
-        .options(joinedload(Tag.confidence))
-        .options(joinedload(Tag.concepts))
-        .options(joinedload(Tag.tag_type))
-        .options(joinedload(Tag.tag_subject))
+        select(Tag.id)
         .where(Tag.identifier == identifier)
         .where(Tag.tagpack_id == TagPack.id)
         .where(TagPack.acl_group.in_(groups))
         .where(Confidence.id == Tag.confidence_id)
         .offset(offset)
         .limit(page_size)
-        .order_by(desc(Confidence.level))
+        .order_by(*_tags_order())
     )
 
     if network is not None:
         q = q.where(Tag.network == network)
+    return _after_cursor(q, cursor)
+
+
+def _get_tag_ids_by_subjectids_stmt(
+    subjects: List[Tuple[str, Optional[str]]],
+    page_size: Optional[int],
+    groups: List[str],
+):
+    """(subject index, tag id) pairs for many (identifier, network) pairs.
+
+    The requested subjects are joined as a VALUES list, each tag is ranked
+    within its subject so the page size is applied per subject and not to
+    the whole result. A network of None matches tags on all networks.
+    """
+    subjects_values = sa_values(
+        column("idx", Integer),
+        column("identifier", String),
+        column("network", String),
+        name="subjects",
+    ).data([(i, s, n) for i, (s, n) in enumerate(subjects)])
+
+    ranked = (
+        select(
+            subjects_values.c.idx,
+            Tag.id.label("tag_id"),
+            func.row_number()
+            .over(
+                partition_by=subjects_values.c.idx,
+                order_by=_tags_order(),
+            )
+            .label("rank"),
+        )
+        .join_from(
+            subjects_values,
+            Tag,
+            and_(
+                Tag.identifier == subjects_values.c.identifier,
+                or_(
+                    subjects_values.c.network.is_(None),
+                    Tag.network == subjects_values.c.network,
+                ),
+            ),
+        )
+        .where(Tag.tagpack_id == TagPack.id)
+        .where(TagPack.acl_group.in_(groups))
+        .where(Confidence.id == Tag.confidence_id)
+        .subquery()
+    )
+
+    q = select(ranked.c.idx, ranked.c.tag_id).order_by(ranked.c.idx, ranked.c.rank)
+
+    if page_size is not None:
+        q = q.where(ranked.c.rank <= page_size)
+
     return q
 
 
-def _get_tag_by_id_stmt(tag_id: int, groups: List[str]):
+def _get_tag_id_by_id_stmt(tag_id: int, groups: List[str]):
     return (
-        select(Tag, TagPack)
-        .options(joinedload(Tag.confidence))
-        .options(joinedload(Tag.concepts))
-        .options(joinedload(Tag.tag_type))
-        .options(joinedload(Tag.tag_subject))
+        select(Tag.id)
         .where(Tag.id == tag_id)
         .where(Tag.tagpack_id == TagPack.id)
         .where(TagPack.acl_group.in_(groups))
@@ -295,13 +531,9 @@ def _get_tag_by_id_stmt(tag_id: int, groups: List[str]):
     )
 
 
-def _get_best_cluster_tag_stmt(cluster_id: int, network: str, groups: List[str]):
+def _get_best_cluster_tag_id_stmt(cluster_id: int, network: str, groups: List[str]):
     return (
-        select(Tag, TagPack, Confidence)
-        .options(joinedload(Tag.confidence))
-        .options(joinedload(Tag.concepts))
-        .options(joinedload(Tag.tag_type))
-        .options(joinedload(Tag.tag_subject))
+        select(Tag.id)
         .where(BestClusterTagView.cluster_id == cluster_id)
         .where(BestClusterTagView.network == network)
         .where(Tag.tagpack_id == TagPack.id)
@@ -313,83 +545,76 @@ def _get_best_cluster_tag_stmt(cluster_id: int, network: str, groups: List[str])
     )
 
 
-def _get_tags_by_actorid_stmt(
+def _get_tag_ids_by_actorid_stmt(
     actor: str,
     offset: Optional[int],
     page_size: Optional[int],
     groups: List[str],
     network: Optional[str],
+    cursor: Optional[TagsCursor] = None,
 ):
     q = (
-        select(Tag, TagPack, Confidence)
-        .options(joinedload(Tag.confidence))
-        .options(joinedload(Tag.concepts))
-        .options(joinedload(Tag.tag_type))
-        .options(joinedload(Tag.tag_subject))
+        select(Tag.id)
         .where(Tag.actor_id == actor)
         .where(Tag.tagpack_id == TagPack.id)
         .where(TagPack.acl_group.in_(groups))
         .where(Confidence.id == Tag.confidence_id)
         .offset(offset)
         .limit(page_size)
-        .order_by(desc(Confidence.level))
+        .order_by(*_tags_order())
     )
     if network is not None:
         q = q.where(Tag.network == network)
-    return q
+    return _after_cursor(q, cursor)
 
 
-def _get_tags_by_clusterid_stmt(
+def _get_tag_ids_by_clusterid_stmt(
     cluster_id: int,
     network: str,
     offset: Optional[int],
     page_size: Optional[int],
     groups: List[str],
     exclude_identifiers: Optional[List[str]],
+    cursor: Optional[TagsCursor] = None,
 ):
     q = (
-        select(Tag, TagPack, AddressClusterMapping, Confidence)
-        .options(joinedload(Tag.confidence))
-        .options(joinedload(Tag.concepts))
-        .options(joinedload(Tag.tag_type))
-        .options(joinedload(Tag.tag_subject))
-        .where(AddressClusterMapping.gs_cluster_id == cluster_id)
-        .where(AddressClusterMapping.address == Tag.identifier)
-        .where(AddressClusterMapping.network == Tag.network)
-        .where(Tag.network == network)
-        .where(Tag.tagpack_id == TagPack.id)
-        .where(TagPack.acl_group.in_(groups))
-        .where(Confidence.id == Tag.confidence_id)
+        select(ClusterTag.tag_id)
+        .where(ClusterTag.gs_cluster_id == cluster_id)
+        .where(ClusterTag.network == network)
+        .where(ClusterTag.acl_group.in_(groups))
     )
 
     if exclude_identifiers is not None:
-        q = q.where(Tag.identifier.not_in(exclude_identifiers))
+        q = q.where(ClusterTag.tag_id == Tag.id).where(
+            Tag.identifier.not_in(exclude_identifiers)
+        )
 
-    return q.offset(offset).limit(page_size).order_by(desc(Confidence.level))
+    order = (ClusterTag.confidence_level, ClusterTag.tag_id)
+    q = q.offset(offset).limit(page_size).order_by(*_tags_order(*order))
+    return _after_cursor(q, cursor, *order)
 
 
-def _get_tags_by_label_stmt(
+def _get_tag_ids_by_label_stmt(
     label: str,
     offset: Optional[int],
     page_size: Optional[int],
     groups: List[str],
     network: Optional[str],
+    cursor: Optional[TagsCursor] = None,
 ):
     q = (
-        select(Tag, TagPack)
-        .options(joinedload(Tag.confidence))
-        .options(joinedload(Tag.concepts))
-        .options(joinedload(Tag.tag_type))
-        .options(joinedload(Tag.tag_subject))
+        select(Tag.id)
         .where(Tag.label.like(f"%{label}%"))
         .where(Tag.tagpack_id == TagPack.id)
         .where(TagPack.acl_group.in_(groups))
+        .where(Confidence.id == Tag.confidence_id)
         .offset(offset)
         .limit(page_size)
+        .order_by(*_tags_order())
     )
     if network is not None:
         q = q.where(Tag.network == network)
-    return q
+    return _after_cursor(q, cursor)
 
 
 def _get_actor_by_id_stmt(actor: str):
@@ -411,16 +636,17 @@ def _get_per_network_statistics_stmt():
 
 def _get_per_network_statistics_cached_stmt():
     return text(
-        "select network, nr_labels, nr_tags, nr_identifiers_explicit, nr_identifiers_implicit from statistics"
+        "select network, nr_labels, nr_tags, nr_identifiers_explicit, "
+        "nr_identifiers_implicit from statistics"
     )
 
 
 def _get_count_by_cluster_stmt(cluster_id: int, network: str, groups: List[str]):
     return (
-        select(TagCountByClusterView)
-        .where(TagCountByClusterView.network == network)
-        .where(TagCountByClusterView.gs_cluster_id == cluster_id)
-        .where(TagCountByClusterView.acl_group.in_(groups))
+        select(func.count())
+        .where(ClusterTag.gs_cluster_id == cluster_id)
+        .where(ClusterTag.network == network)
+        .where(ClusterTag.acl_group.in_(groups))
     )
 
 
@@ -466,13 +692,11 @@ def _get_actors_for_subject_stmt(subject_id: str, groups: List[str]):
 def _get_actors_for_clusterid_stmt(cluster_id: int, network: int, groups: List[str]):
     return (
         select(Actor.id, Actor.label)
-        .where(AddressClusterMapping.gs_cluster_id == cluster_id)
-        .where(AddressClusterMapping.address == Tag.identifier)
-        .where(AddressClusterMapping.network == network)
-        .where(Actor.id.isnot(None))
+        .where(ClusterTag.gs_cluster_id == cluster_id)
+        .where(ClusterTag.network == network)
+        .where(ClusterTag.acl_group.in_(groups))
+        .where(ClusterTag.tag_id == Tag.id)
         .where(Actor.id == Tag.actor_id)
-        .where(Tag.tagpack_id == TagPack.id)
-        .where(TagPack.acl_group.in_(groups))
         .order_by(Actor.label)
         .distinct()
     )
@@ -509,43 +733,237 @@ def _get_acl_groups_statement():
     return select(TagPack.acl_group).distinct()
 
 
-def _get_labels_by_clusterid_stmt(cluster_id: str, groups: List[str]):
+def _acl_groups_key(groups: List[str]) -> str:
+    return ",".join(sorted(set(groups)))
+
+
+def _get_tag_digest_stmt(identifier: str, groups: List[str]):
     return (
-        select(Tag.label)
-        .where(AddressClusterMapping.gs_cluster_id == cluster_id)
-        .where(AddressClusterMapping.address == Tag.identifier)
+        select(TagDigestMaterialized.digest)
+        .where(TagDigestMaterialized.identifier == identifier)
+        .where(TagDigestMaterialized.acl_groups == _acl_groups_key(groups))
+    )
+
+
+def _get_identifiers_for_tag_digests_stmt(groups: List[str], only_missing: bool):
+    q = (
+        select(Tag.identifier)
         .where(Tag.tagpack_id == TagPack.id)
         .where(TagPack.acl_group.in_(groups))
+        .distinct()
+    )
+    if only_missing:
+        q = q.where(
+            ~select(TagDigestMaterialized.identifier)
+            .where(TagDigestMaterialized.identifier == Tag.identifier)
+            .where(TagDigestMaterialized.acl_groups == _acl_groups_key(groups))
+            .exists()
+        )
+    return q
+
+
+def _upsert_tag_digests_stmt(groups: List[str], digests: List[Tuple[str, int, str]]):
+    key = _acl_groups_key(groups)
+    q = pg_insert(TagDigestMaterialized).values(
+        [
+            {"identifier": i, "acl_groups": key, "nr_tags": n, "digest": d}
+            for i, n, d in digests
+        ]
+    )
+    return q.on_conflict_do_update(
+        index_elements=[
+            TagDigestMaterialized.identifier,
+            TagDigestMaterialized.acl_groups,
+        ],
+        set_={
+            "nr_tags": q.excluded.nr_tags,
+            "digest": q.excluded.digest,
+            "lastmod": func.now(),
+        },
+    )
+
+
+def _get_labels_by_clusterid_stmt(cluster_id: str, groups: List[str]):
+    return (
+        select(Tag.label)
+        .where(ClusterTag.gs_cluster_id == cluster_id)
+        .where(ClusterTag.acl_group.in_(groups))
+        .where(ClusterTag.tag_id == Tag.id)
         .order_by(asc(Tag.label))
         .distinct()
     )
 
 
+def _upsert_cluster_tags_stmt(tag_ids: List[int]):
+    """Adds the given tags to the denormalized cluster_tag table (if their
+    address is mapped to a cluster)."""
+    rows = (
+        select(
+            Tag.id,
+            Tag.network,
+            AddressClusterMapping.gs_cluster_id,
+            TagPack.acl_group,
+            Confidence.level,
+        )
+        .where(AddressClusterMapping.address == Tag.identifier)
+        .where(AddressClusterMapping.network == Tag.network)
+        .where(Tag.tagpack_id == TagPack.id)
+        .where(Confidence.id == Tag.confidence_id)
+        .where(Tag.id.in_(tag_ids))
+    )
+    q = pg_insert(ClusterTag).from_select(
+        ["tag_id", "network", "gs_cluster_id", "acl_group", "confidence_level"], rows
+    )
+    return q.on_conflict_do_update(
+        index_elements=[ClusterTag.tag_id],
+        set_={"gs_cluster_id": q.excluded.gs_cluster_id},
+    )
+
+
+def _to_tags_page(results, page_size: Optional[int]) -> TagsPagePublic:
+    next_page = None
+    if page_size is not None and len(results) >= page_size:
+        last = results[-1]
+        next_page = TagsCursor(level=last.confidence_level, tag_id=last.id).encode()
+
+    return TagsPagePublic.model_construct(
+        tags=[TagPublic.fromDBRow(r) for r in results], next_page=next_page
+    )
+
+
 # Facades
 def _inject_session(f):
+    db_call_duration = DB_CALL_DURATION.labels(method=f.__name__)
+
     @wraps(f)
     async def inner_f(self, *args, **kwargs):
         session = kwargs.get("session", None)
 
-        if session is not None:
-            return await f(self, *args, **kwargs)
-        else:
-            async with AsyncSession(self.engine) as session:
-                kwargs["session"] = session
+        start = time.perf_counter()
+        try:
+            if session is not None:
                 return await f(self, *args, **kwargs)
+            else:
+                async with AsyncSession(self.engine) as session:
+                    kwargs["session"] = session
+                    return await f(self, *args, **kwargs)
+        finally:
+            db_call_duration.observe(time.perf_counter() - start)
+
+    return inner_f
+
+
+def _hashable(x) -> Hashable:
+    if isinstance(x, (set, frozenset)):
+        return frozenset(x)
+    elif isinstance(x, (list, tuple)):
+        return tuple(_hashable(i) for i in x)
+    return x
+
+
+def _json_cached(f):
+    """Caches the (JSON bytes) result of f in the response cache of the
+    TagstoreDbAsync instance, if one is configured."""
+
+    @wraps(f)
+    async def inner_f(self, *args, **kwargs):
+        if self.cache is None:
+            return await f(self, *args, **kwargs)
+
+        key = (
+            f.__name__,
+            _hashable(args),
+            tuple(sorted((k, _hashable(v)) for k, v in kwargs.items())),
+        )
+        data = self.cache.get(key)
+        if data is None:
+            data = await f(self, *args, **kwargs)
+            self.cache.set(key, data)
+        return data
+
+    return inner_f
+
+
+def _single_flight(f):
+    """Concurrent calls of f with the same arguments (including the acl
+    groups) share one execution, if the TagstoreDbAsync instance has a
+    SingleFlight. Calls with an explicit session are never coalesced."""
+
+    @wraps(f)
+    async def inner_f(self, *args, **kwargs):
+        if self.single_flight is None or kwargs.get("session", None) is not None:
+            return await f(self, *args, **kwargs)
+
+        key = (
+            f.__name__,
+            _hashable(args),
+            tuple(sorted((k, _hashable(v)) for k, v in kwargs.items())),
+        )
+        return await self.single_flight.do(key, lambda: f(self, *args, **kwargs))
 
     return inner_f
 
 
 class TagstoreDbAsync:
     engine = None
+    cache = None
+    single_flight = None
 
-    def __init__(self, engine):
+    def __init__(
+        self,
+        engine,
+        cache: Optional[ResponseCache] = None,
+        single_flight: Optional[SingleFlight] = None,
+    ):
         self.engine = engine
+        self.cache = cache
+        self.single_flight = single_flight
 
     @staticmethod
-    def from_url(db_url):
-        return TagstoreDbAsync(get_db_engine_async(db_url))
+    def from_url(
+        db_url,
+        cache: Optional[ResponseCache] = None,
+        single_flight: Optional[SingleFlight] = None,
+    ):
+        return TagstoreDbAsync(
+            get_db_engine_async(db_url), cache=cache, single_flight=single_flight
+        )
+
+    def invalidate_cache(self, namespace: Optional[str] = None):
+        if self.cache is not None:
+            self.cache.invalidate(namespace)
+
+    async def stream_tags(
+        self,
+        groups: List[str],
+        network: Optional[str] = None,
+        actor: Optional[str] = None,
+        after_id: Optional[int] = None,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[List[TagExportPublic]]:
+        """Yields all matching tags in batches, ordered by tag id.
+
+        Rows are fetched through a server side cursor, so memory use does
+        not depend on the size of the result. The session is owned by the
+        generator since it usually outlives the calling request handler.
+        """
+        stmt = _get_tag_rows_for_export_stmt(groups, network, actor, after_id)
+        async with AsyncSession(self.engine) as session:
+            result = await session.stream(stmt.execution_options(yield_per=batch_size))
+            async for rows in result.partitions(batch_size):
+                yield [TagExportPublic.fromDBRow(r) for r in rows]
+
+    async def _get_tag_rows(self, tag_ids: List[int], session) -> Dict[int, Row]:
+        """Loads plain tag rows for a page of tag ids."""
+        if len(tag_ids) == 0:
+            return {}
+        results = await session.exec(_get_tag_rows_by_ids_stmt(tag_ids))
+        return {r.id: r for r in results}
+
+    async def _get_tag_rows_page(self, ids_stmt, session) -> List[Row]:
+        tag_ids = list(await session.exec(ids_stmt))
+        by_id = await self._get_tag_rows(tag_ids, session)
+        return [by_id[i] for i in tag_ids if i in by_id]
 
     # get Tag by id
 
@@ -556,8 +974,11 @@ class TagstoreDbAsync:
         tag_id: int,
         groups: List[str],
         session=None,
-    ) -> Optional[Tag]:
-        return await session.exec(_get_tag_by_id_stmt(tag_id, groups)).first()
+    ) -> Optional[Row]:
+        results = await self._get_tag_rows_page(
+            _get_tag_id_by_id_stmt(tag_id, groups), session
+        )
+        return results[0] if results else None
 
     @_inject_session
     async def get_tag_by_id(
@@ -568,8 +989,7 @@ class TagstoreDbAsync:
     ) -> Optional[TagPublic]:
         result = await self._get_tag_by_id(tag_id, groups, session=session)
         if result is not None:
-            t, tp = result
-            return TagPublic.fromDB(t, tp)
+            return TagPublic.fromDBRow(result)
 
         return None
 
@@ -580,6 +1000,10 @@ class TagstoreDbAsync:
     ) -> List[str]:
         return await session.exec(_get_acl_groups_statement())
 
+    @_json_cached
+    async def get_acl_groups_json(self) -> bytes:
+        return json.dumps(list(await self.get_acl_groups())).encode("utf-8")
+
     # Get Tags by subject id
     @_inject_session
     async def _get_tags_by_subjectid(
@@ -589,16 +1013,22 @@ class TagstoreDbAsync:
         page_size: int,
         groups: List[str],
         network: Optional[str] = None,
+        cursor: Optional[TagsCursor] = None,
         session=None,
-    ) -> List[Tag]:
-        return (
-            await session.exec(
-                _get_tags_by_subjectid_stmt(
-                    identifier, offset, page_size, groups, network=network
-                )
-            )
-        ).unique()
+    ) -> List[Row]:
+        return await self._get_tag_rows_page(
+            _get_tag_ids_by_subjectid_stmt(
+                identifier,
+                offset,
+                page_size,
+                groups,
+                network=network,
+                cursor=cursor,
+            ),
+            session,
+        )
 
+    @_single_flight
     @_inject_session
     async def get_tags_by_subjectid(
         self,
@@ -617,7 +1047,58 @@ class TagstoreDbAsync:
             network=network,
             session=session,
         )
-        return [TagPublic.fromDB(t, tp) for t, tp, _ in results]
+        return [TagPublic.fromDBRow(r) for r in results]
+
+    @_single_flight
+    @_inject_session
+    async def get_tags_page_by_subjectid(
+        self,
+        subject_id: str,
+        cursor: Optional[TagsCursor],
+        page_size: int,
+        groups: List[str],
+        network: Optional[str] = None,
+        session=None,
+    ) -> TagsPagePublic:
+        results = await self._get_tags_by_subjectid(
+            subject_id.strip(),
+            None,
+            page_size,
+            groups,
+            network=network,
+            cursor=cursor,
+            session=session,
+        )
+        return _to_tags_page(results, page_size)
+
+    @_inject_session
+    async def get_tags_by_subjectids(
+        self,
+        subjects: List[Tuple[str, Optional[str]]],
+        page_size: Optional[int],
+        groups: List[str],
+        session=None,
+    ) -> List[TagsBySubjectPublic]:
+        subjects = [(s.strip(), n) for s, n in subjects]
+        if len(subjects) == 0:
+            return []
+
+        ranked_ids = list(
+            await session.exec(
+                _get_tag_ids_by_subjectids_stmt(subjects, page_size, groups)
+            )
+        )
+        by_id = await self._get_tag_rows([i for _, i in ranked_ids], session)
+
+        tags_by_subject = [[] for _ in subjects]
+        for idx, tag_id in ranked_ids:
+            if tag_id in by_id:
+                tags_by_subject[idx].append(TagPublic.fromDBRow(by_id[tag_id]))
+
+        return [
+            TagsBySubjectPublic.model_construct(subject_id=s, network=n, tags=tags)
+            for (s, n), tags in zip(subjects, tags_by_subject)
+        ]
 
     @_inject_session
     async def get_actors_by_subjectid(
@@ -663,16 +1144,22 @@ class TagstoreDbAsync:
         page_size: Optional[int],
         groups: List[str],
         network: Optional[str] = None,
+        cursor: Optional[TagsCursor] = None,
         session=None,
-    ) -> List[Tag]:
-        return (
-            await session.exec(
-                _get_tags_by_label_stmt(
-                    label.strip(), offset, page_size, groups, network=network
-                )
-            )
-        ).unique()
+    ) -> List[Row]:
+        return await self._get_tag_rows_page(
+            _get_tag_ids_by_label_stmt(
+                label.strip(),
+                offset,
+                page_size,
+                groups,
+                network=network,
+                cursor=cursor,
+            ),
+            session,
+        )
 
+    @_single_flight
     @_inject_session
     async def get_tags_by_label(
         self,
@@ -686,7 +1173,29 @@ class TagstoreDbAsync:
         results = await self._get_tags_by_label(
             label.strip(), offset, page_size, groups, network=network, session=session
         )
-        return [TagPublic.fromDB(t, tp) for t, tp in results]
+        return [TagPublic.fromDBRow(r) for r in results]
+
+    @_single_flight
+    @_inject_session
+    async def get_tags_page_by_label(
+        self,
+        label: str,
+        cursor: Optional[TagsCursor],
+        page_size: int,
+        groups: List[str],
+        network: Optional[str] = None,
+        session=None,
+    ) -> TagsPagePublic:
+        results = await self._get_tags_by_label(
+            label.strip(),
+            None,
+            page_size,
+            groups,
+            network=network,
+            cursor=cursor,
+            session=session,
+        )
+        return _to_tags_page(results, page_size)
 
     # Cluster
 
@@ -699,16 +1208,23 @@ class TagstoreDbAsync:
         page_size: Optional[int],
         groups: List[str],
         exclude_identifiers: Optional[List[str]],
+        cursor: Optional[TagsCursor] = None,
         session=None,
-    ) -> List[Tag]:
-        return (
-            await session.exec(
-                _get_tags_by_clusterid_stmt(
-                    cluster_id, network, offset, page_size, groups, exclude_identifiers
-                )
-            )
-        ).unique()
+    ) -> List[Row]:
+        return await self._get_tag_rows_page(
+            _get_tag_ids_by_clusterid_stmt(
+                cluster_id,
+                network,
+                offset,
+                page_size,
+                groups,
+                exclude_identifiers,
+                cursor=cursor,
+            ),
+            session,
+        )
 
+    @_single_flight
     @_inject_session
     async def get_tags_by_clusterid(
         self,
@@ -729,7 +1245,31 @@ class TagstoreDbAsync:
             exclude_identifiers=exclude_identifiers,
             session=session,
         )
-        return [TagPublic.fromDB(t, tp) for t, tp, _, _ in results]
+        return [TagPublic.fromDBRow(r) for r in results]
+
+    @_single_flight
+    @_inject_session
+    async def get_tags_page_by_clusterid(
+        self,
+        cluster_id: int,
+        network: str,
+        cursor: Optional[TagsCursor],
+        page_size: int,
+        groups: List[str],
+        exclude_identifiers: Optional[List[str]] = None,
+        session=None,
+    ) -> TagsPagePublic:
+        results = await self._get_tags_by_clusterid(
+            cluster_id,
+            network,
+            None,
+            page_size,
+            groups,
+            exclude_identifiers=exclude_identifiers,
+            cursor=cursor,
+            session=session,
+        )
+        return _to_tags_page(results, page_size)
 
     @_inject_session
     async def get_nr_tags_by_clusterid(
@@ -739,7 +1279,7 @@ class TagstoreDbAsync:
             _get_count_by_cluster_stmt(cluster_id, network, groups)
         )
 
-        return sum(x.count for x in results)
+        return results.one()
 
     @_inject_session
     async def get_actors_by_clusterid(
@@ -752,6 +1292,7 @@ class TagstoreDbAsync:
 
     # Actor
 
+    @_single_flight
     @_inject_session
     async def get_actor_by_id(
         self, identifier: str, include_tag_count: bool, session=None
@@ -777,16 +1318,22 @@ class TagstoreDbAsync:
         page_size: Optional[int],
         groups: List[str],
         network: Optional[str] = None,
+        cursor: Optional[TagsCursor] = None,
         session=None,
-    ) -> List[Tag]:
-        return (
-            await session.exec(
-                _get_tags_by_actorid_stmt(
-                    actor.strip(), offset, page_size, groups, network=network
-                )
-            )
-        ).unique()
+    ) -> List[Row]:
+        return await self._get_tag_rows_page(
+            _get_tag_ids_by_actorid_stmt(
+                actor.strip(),
+                offset,
+                page_size,
+                groups,
+                network=network,
+                cursor=cursor,
+            ),
+            session,
+        )
 
+    @_single_flight
     @_inject_session
     async def get_tags_by_actorid(
         self,
@@ -800,23 +1347,78 @@ class TagstoreDbAsync:
         results = await self._get_tags_by_actorid(
             actor.strip(), offset, page_size, groups, network=network, session=session
         )
-        return [TagPublic.fromDB(t, tp) for t, tp, _ in results]
+        return [TagPublic.fromDBRow(r) for r in results]
+
+    @_single_flight
+    @_inject_session
+    async def get_tags_page_by_actorid(
+        self,
+        actor: str,
+        cursor: Optional[TagsCursor],
+        page_size: int,
+        groups: List[str],
+        network: Optional[str] = None,
+        session=None,
+    ) -> TagsPagePublic:
+        results = await self._get_tags_by_actorid(
+            actor.strip(),
+            None,
+            page_size,
+            groups,
+            network=network,
+            cursor=cursor,
+            session=session,
+        )
+        return _to_tags_page(results, page_size)
 
     # Other tag stuff
 
+    @_single_flight
     @_inject_session
     async def get_best_cluster_tag(
         self, cluster_id: int, network: str, groups: List[str], session=None
     ) -> Optional[TagPublic]:
-        result = (
-            await session.exec(_get_best_cluster_tag_stmt(cluster_id, network, groups))
-        ).first()
-        if result is not None:
-            t, tp, _ = result
-            return TagPublic.fromDB(t, tp, inherited_from=InheritedFrom.CLUSTER)
+        results = await self._get_tag_rows_page(
+            _get_best_cluster_tag_id_stmt(cluster_id, network, groups), session
+        )
+        if results:
+            return TagPublic.fromDBRow(results[0], inherited_from=InheritedFrom.CLUSTER)
 
         return None
 
+    # Materialized tag digests
+
+    @_single_flight
+    @_inject_session
+    async def get_tag_digest_json(
+        self, identifier: str, groups: List[str], session=None
+    ) -> Optional[bytes]:
+        """Stored digest of identifier for exactly this set of groups or None."""
+        digest = (
+            await session.exec(_get_tag_digest_stmt(identifier.strip(), groups))
+        ).first()
+        return digest.encode("utf-8") if digest is not None else None
+
+    @_inject_session
+    async def get_identifiers_for_tag_digests(
+        self, groups: List[str], only_missing: bool = True, session=None
+    ) -> List[str]:
+        return list(
+            await session.exec(
+                _get_identifiers_for_tag_digests_stmt(groups, only_missing)
+            )
+        )
+
+    @_inject_session
+    async def store_tag_digests(
+        self, groups: List[str], digests: List[Tuple[str, int, str]], session=None
+    ):
+        """Stores (identifier, nr_tags, serialized digest) triples."""
+        if len(digests) == 0:
+            return
+        await session.execute(_upsert_tag_digests_stmt(groups, digests))
+        await session.commit()
+
     # Other
     @_inject_session
     async def get_taxonomies(
@@ -875,6 +1477,12 @@ class TagstoreDbAsync:
             ),
         )
 
+    @_json_cached
+    async def get_taxonomies_json(
+        self, include: Set[Taxonomies] = _ALL_TAXONOMIES
+    ) -> bytes:
+        return (await self.get_taxonomies(include)).model_dump_json().encode("utf-8")
+
     @_inject_session
     async def get_network_statistics(self, session=None) -> TagstoreStatisticsPublic:
         results = await session.exec(_get_per_network_statistics_stmt())
@@ -907,6 +1515,14 @@ class TagstoreDbAsync:
             }
         )
 
+    @_json_cached
+    async def get_network_statistics_cached_json(self) -> bytes:
+        return (
+            (await self.get_network_statistics_cached())
+            .model_dump_json()
+            .encode("utf-8")
+        )
+
     @_inject_session
     async def search_tag_labels(
         self, label: str, limit: int, groups: List[str], session=None
@@ -951,7 +1567,9 @@ class TagstoreDbAsync:
             tpN = TagPack(
                 id=IDUserReportedTagpack,
                 title="User Reported Tags",
-                description="Tagpack of tags reported by end-users via the dashboard UI",
+                description=(
+                    "Tagpack of tags reported by end-users via the dashboard UI"
+                ),
                 creator="The Graphsense Community",
                 acl_group=acl_group,
             )
@@ -985,6 +1603,13 @@ class TagstoreDbAsync:
         session.add(tagN)
 
         try:
+            await session.flush()
+            await session.execute(_upsert_cluster_tags_stmt([tagN.id]))
+            await session.execute(
+                delete(TagDigestMaterialized).where(
+                    TagDigestMaterialized.identifier == tagN.identifier
+                )
+            )
             await session.commit()
         except IntegrityError as e:
             if (
@@ -998,4 +1623,7 @@ class TagstoreDbAsync:
             else:
                 raise e
 
+        # a new tagpack may introduce a new acl group
+        self.invalidate_cache("get_acl_groups_json")
+
         return unique_id
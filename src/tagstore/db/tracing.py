@@ -0,0 +1,116 @@
+"""Per-request SQL tracing and slow query log.
+
+install_sql_tracing hooks into the cursor events of an engine and records
+every statement (duration and row count) into the SqlTrace of the current
+context, see sql_trace. Statements slower than the threshold are logged with
+the route and parameters they were issued for.
+"""
+
+import contextlib
+import contextvars
+import logging
+import time
+from typing import Any, List, Optional
+
+from pydantic import BaseModel
+from sqlalchemy import event
+
+logger = logging.getLogger("uvicorn.error")
+
+_QUERY_START_KEY = "tagstore_query_start"
+
+
+class TracedStatement(BaseModel):
+    statement: str
+    parameters: Any = None
+    duration: float
+    rowcount: int
+    explain: Optional[List[str]] = None
+
+
+class SqlTrace(BaseModel):
+    route: str
+    explain: bool = False
+    statements: List[TracedStatement] = []
+
+    @property
+    def duration(self) -> float:
+        return sum(s.duration for s in self.statements)
+
+
+_current_trace: contextvars.ContextVar[Optional[SqlTrace]] = contextvars.ContextVar(
+    "tagstore_sql_trace", default=None
+)
+
+
+@contextlib.contextmanager
+def sql_trace(route: str, explain: bool = False):
+    """Collects the statements issued in this context (and in tasks started
+    from it) into a SqlTrace. With explain=True the plan of every select
+    statement is captured as well."""
+    trace = SqlTrace(route=route, explain=explain)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def _explain(conn, statement: str, parameters) -> List[str]:
+    # use a fresh dbapi cursor, the original one still holds the results
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(f"EXPLAIN {statement}", parameters)
+        return [r[0] for r in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def install_sql_tracing(engine, slow_query_threshold: float):
+    """Registers the tracing listeners on engine (sync or async).
+
+    Args:
+        engine: the engine to trace
+        slow_query_threshold: statements taking longer (in seconds) are logged
+    """
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault(_QUERY_START_KEY, []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        duration = time.perf_counter() - conn.info[_QUERY_START_KEY].pop()
+        trace = _current_trace.get()
+        traced = TracedStatement(
+            statement=statement,
+            parameters=parameters,
+            duration=duration,
+            rowcount=cursor.rowcount,
+        )
+
+        if (
+            trace is not None
+            and trace.explain
+            and not many
+            and statement.lstrip().upper().startswith(("SELECT", "WITH"))
+        ):
+            try:
+                traced.explain = _explain(conn, statement, parameters)
+            except Exception as e:
+                logger.warning(f"Could not explain statement: {e}")
+
+        if trace is not None:
+            trace.statements.append(traced)
+
+        if duration >= slow_query_threshold:
+            route = trace.route if trace is not None else "-"
+            logger.warning(
+                f"Slow query ({duration * 1000:.1f} ms, {traced.rowcount} rows) "
+                f"on {route}: {statement} -- parameters: {parameters}"
+            )
+            if traced.explain:
+                logger.warning("Query plan:\n" + "\n".join(traced.explain))
+
+    return sync_engine
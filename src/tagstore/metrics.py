@@ -0,0 +1,256 @@
+"""Minimal in-process metrics in the Prometheus text exposition format.
+
+Only what the tagstore api needs: counters, gauges and histograms with
+labels, rendered by the /metrics endpoint. The api mirrors the relevant part
+of prometheus_client (labels(...).inc/set/observe).
+"""
+
+import math
+from abc import ABC, abstractmethod
+from typing import Dict, List, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs: List[Tuple[str, str]]) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class _Metric(ABC):
+    type_ = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[tuple, object] = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    @abstractmethod
+    def _new_child(self):
+        """A new child (the value of one set of label values)."""
+
+    def labels(self, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        child = self._children.get(key, None)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def clear(self):
+        self._children = {} if self.labelnames else {(): self._new_child()}
+
+    @abstractmethod
+    def _samples(self):
+        """Yields (name suffix, label pairs, value) of all children."""
+
+    def _values(self, suffix: str = ""):
+        for key, child in list(self._children.items()):
+            yield suffix, list(zip(self.labelnames, key)), child.value
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_}",
+        ]
+        for suffix, pairs, value in self._samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(pairs)} {_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class _CounterValue:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        if amount < 0:
+            raise ValueError("Counters can only be incremented")
+        self.value += amount
+
+
+class _GaugeValue:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):  # noqa: A003
+        self.value = value
+
+
+class Counter(_Metric):
+    type_ = "counter"
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        return self._values("_total")
+
+
+class Gauge(_Metric):
+    type_ = "gauge"
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):  # noqa: A003
+        self.labels().set(value)
+
+    def _samples(self):
+        return self._values()
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Histogram(_Metric):
+    type_ = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS
+    ):
+        self.buckets = tuple(float(b) for b in sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self):
+        for key, child in list(self._children.items()):
+            pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, cnt in zip(child.buckets, child.counts):
+                cumulative += cnt
+                yield "_bucket", pairs + [("le", _format_value(bound))], cumulative
+            yield "_sum", pairs, child.sum
+            yield "_count", pairs, child.count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Web api
+REQUEST_DURATION = REGISTRY.register(
+    Histogram(
+        "tagstore_http_request_duration_seconds",
+        "Latency of http requests by route.",
+        labelnames=("method", "route", "status"),
+    )
+)
+REQUESTS_IN_FLIGHT = REGISTRY.register(
+    Gauge("tagstore_http_requests_in_flight", "Http requests currently served.")
+)
+
+# Executor for cpu heavy work (tag digests, large responses)
+CPU_EXECUTOR_PENDING = REGISTRY.register(
+    Gauge(
+        "tagstore_cpu_executor_pending",
+        "Tasks submitted to the cpu executor and not finished yet.",
+    )
+)
+CPU_EXECUTOR_QUEUE_DEPTH = REGISTRY.register(
+    Gauge(
+        "tagstore_cpu_executor_queue_depth",
+        "Tasks waiting for a free cpu executor worker.",
+    )
+)
+
+# Database
+DB_CALL_DURATION = REGISTRY.register(
+    Histogram(
+        "tagstore_db_call_duration_seconds",
+        "Duration (and count) of TagstoreDbAsync calls by method.",
+        labelnames=("method",),
+    )
+)
+
+# Response cache and request coalescing (single flight)
+CACHE_HITS = REGISTRY.register(
+    Counter("tagstore_response_cache_hits", "Response cache hits.")
+)
+CACHE_MISSES = REGISTRY.register(
+    Counter("tagstore_response_cache_misses", "Response cache misses.")
+)
+CACHE_ENTRIES = REGISTRY.register(
+    Gauge(
+        "tagstore_response_cache_entries",
+        "Entries in the response cache, updated when metrics are collected.",
+    )
+)
+COALESCED_CALLS = REGISTRY.register(
+    Counter(
+        "tagstore_db_coalesced_calls",
+        "Db calls that awaited an identical call in flight.",
+    )
+)
+
+# Connection pool, updated when metrics are collected
+POOL_STATS = REGISTRY.register(
+    Gauge(
+        "tagstore_db_pool",
+        "Db connection pool statistics (size, checked_out, overflow, saturation).",
+        labelnames=("stat",),
+    )
+)
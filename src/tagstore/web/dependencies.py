@@ -1,11 +1,12 @@
 from typing import Annotated, List, Optional
 
 from fastapi import Depends, HTTPException, Query, Request
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from sqlmodel import Session
 
 from ..config import TagstoreSettings
-from ..db import TagstoreDbAsync
+from ..db import TagsCursor, TagstoreDbAsync
+from .executor import CpuBoundExecutor
 
 
 def _get_session(request: Request):
@@ -15,7 +16,11 @@ def _get_session(request: Request):
 
 
 def _get_tagstore_db_async(request: Request):
-    return TagstoreDbAsync(request.app.state.db_engine)
+    return TagstoreDbAsync(
+        request.app.state.db_engine,
+        cache=getattr(request.app.state, "response_cache", None),
+        single_flight=getattr(request.app.state, "single_flight", None),
+    )
 
 
 class PageingState(BaseModel):
@@ -31,6 +36,11 @@ class PageingState(BaseModel):
         return self.page_size
 
 
+class CursorPageingState(BaseModel):
+    cursor: Optional[TagsCursor]
+    page_size: int
+
+
 class TagsQueryParams(BaseModel):
     label: Optional[str] = None
     actor_id: Optional[str] = None
@@ -39,6 +49,27 @@ class TagsQueryParams(BaseModel):
     network: Optional[str] = None
 
 
+class SubjectQuery(BaseModel):
+    subject_id: str
+    network: Optional[str] = None
+
+
+class SubjectsQuery(BaseModel):
+    subjects: List[SubjectQuery] = Field(max_length=1000)
+
+    def subject_network_pairs(self):
+        return [
+            (s.subject_id, s.network.upper() if s.network else None)
+            for s in self.subjects
+        ]
+
+
+class TagsBatchQuery(SubjectsQuery):
+    page_size: int = Field(
+        default=50, gt=0, le=5000, description="max. number of tags per subject"
+    )
+
+
 def _get_tags_query_params(
     label: Optional[str] = None,
     actor_id: Optional[str] = None,
@@ -80,6 +111,26 @@ async def _paging_parameters(
     return PageingState(page_nr=page_nr, page_size=page_size)
 
 
+async def _cursor_paging_parameters(
+    page: Annotated[
+        Optional[str],
+        Query(
+            alias="page",
+            description="Token of the page to serve (next_page of the previous one)",
+        ),
+    ] = None,
+    page_size: Annotated[
+        int,
+        Query(alias="page_size", description="size of a page", le=5000, gt=0),
+    ] = 50,
+) -> CursorPageingState:
+    try:
+        cursor = TagsCursor.decode(page) if page else None
+    except ValueError:
+        raise HTTPException(400, f"Invalid page token {page}")
+    return CursorPageingState(cursor=cursor, page_size=page_size)
+
+
 async def _acl_groups(
     groups: Annotated[
         Optional[List[str]],
@@ -97,14 +148,22 @@ async def _db(request: Request):
     return request.app.state.db
 
 
+def _cpu_executor(request: Request) -> CpuBoundExecutor:
+    return request.app.state.cpu_executor
+
+
 TsSettingsParam = Annotated[TagstoreSettings, Depends(_gs_tagstore_settings)]
 
 TsDbSessionParam = Annotated[Session, Depends(_get_session)]
 
 TsDbParam = Annotated[TagstoreDbAsync, Depends(_get_tagstore_db_async)]
 
+TsCpuExecutorParam = Annotated[CpuBoundExecutor, Depends(_cpu_executor)]
+
 TsPagingParam = Annotated[PageingState, Depends(_paging_parameters)]
 
+TsCursorPagingParam = Annotated[CursorPageingState, Depends(_cursor_paging_parameters)]
+
 # TsIdentifierParam = Annotated[
 #     str, Path(alias="identifier", description="Address or Transaction-hash")
 # ]
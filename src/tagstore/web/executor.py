@@ -0,0 +1,51 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from .. import metrics
+
+
+class CpuBoundExecutor:
+    """Bounded pool for cpu heavy work (tag digests, serialization of large
+    responses) so it does not block the event loop.
+
+    With kind="process" the functions and their arguments must be picklable,
+    i.e. module level functions.
+    """
+
+    def __init__(self, max_workers: int, kind: str = "thread"):
+        self.max_workers = max_workers
+        self.kind = kind
+        self.pending = 0
+        if kind == "process":
+            self._executor: Executor = ProcessPoolExecutor(max_workers=max_workers)
+        elif kind == "thread":
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="tagstore-cpu"
+            )
+        else:
+            raise ValueError(f"Unknown executor kind {kind}, use thread or process")
+        self._update_metrics()
+
+    @property
+    def queue_depth(self) -> int:
+        """Submitted tasks waiting for a free worker."""
+        return max(0, self.pending - self.max_workers)
+
+    def _update_metrics(self):
+        metrics.CPU_EXECUTOR_PENDING.set(self.pending)
+        metrics.CPU_EXECUTOR_QUEUE_DEPTH.set(self.queue_depth)
+
+    async def run(self, fn, *args):
+        # only touched from the event loop, no locking needed
+        self.pending += 1
+        self._update_metrics()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, fn, *args
+            )
+        finally:
+            self.pending -= 1
+            self._update_metrics()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,16 +1,28 @@
+import logging
 import os
+import time
 from contextlib import asynccontextmanager
 from typing import List, Tuple
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
-from ..db.database import get_db_engine_async
+from .. import metrics
+from ..db.cache import ResponseCache, SingleFlight
+from ..db.database import (
+    get_db_engine_async_from_settings,
+    get_pool_stats,
+    prewarm_pool,
+)
+from ..db.tracing import install_sql_tracing, sql_trace
 from .dependencies import _gs_tagstore_settings
+from .executor import CpuBoundExecutor
 from .routers.admin import router as admin_router
 from .routers.base import router as base_router
 
+logger = logging.getLogger("uvicorn.error")
+
 
 class SinglePageApplication(StaticFiles):
     """Acts similar to the bripkens/connect-history-api-fallback
@@ -49,8 +61,26 @@ class SinglePageApplication(StaticFiles):
 async def lifespan(app: FastAPI):
     global background_executor
     settings = _gs_tagstore_settings()
-    app.state.db_engine = get_db_engine_async(settings.db_url)
+    app.state.db_engine = get_db_engine_async_from_settings(settings)
+    app.state.sql_trace = settings.sql_trace
+    app.state.sql_trace_explain = settings.sql_trace_explain
+    if settings.sql_trace:
+        install_sql_tracing(app.state.db_engine, settings.sql_slow_query_ms / 1000)
+    if settings.db_pool_prewarm:
+        try:
+            await prewarm_pool(app.state.db_engine, settings.db_pool_size)
+        except Exception as e:
+            logger.warning(f"Could not pre-warm the db connection pool: {e}")
+    app.state.response_cache = ResponseCache(
+        ttl=settings.cache_ttl, max_entries=settings.cache_max_entries
+    )
+    app.state.single_flight = SingleFlight() if settings.coalesce_requests else None
+    app.state.cpu_executor = CpuBoundExecutor(
+        settings.cpu_executor_workers, kind=settings.cpu_executor
+    )
     yield
+    app.state.cpu_executor.shutdown()
+    await app.state.db_engine.dispose()
 
 
 app = FastAPI(
@@ -69,6 +99,67 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def collect_request_metrics(request: Request, call_next):
+    metrics.REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.REQUESTS_IN_FLIGHT.dec()
+        # use the route template, not the path, to keep the label set small
+        route = request.scope.get("route", None)
+        metrics.REQUEST_DURATION.labels(
+            method=request.method,
+            route=route.path if route is not None else "other",
+            status=status,
+        ).observe(time.perf_counter() - start)
+
+
+@app.middleware("http")
+async def trace_sql_statements(request: Request, call_next):
+    if not getattr(request.app.state, "sql_trace", False):
+        return await call_next(request)
+
+    explain = request.app.state.sql_trace_explain and request.headers.get(
+        "x-tagstore-explain", ""
+    ).lower() in ("1", "true")
+    route = f"{request.method} {request.url.path}"
+    if request.url.query:
+        route += f"?{request.url.query}"
+
+    with sql_trace(route, explain=explain) as trace:
+        response = await call_next(request)
+
+    response.headers["Server-Timing"] = (
+        f'db;dur={trace.duration * 1000:.1f};desc="{len(trace.statements)} queries"'
+    )
+    if explain:
+        for s in trace.statements:
+            logger.info(
+                f"{route} ({s.duration * 1000:.1f} ms, {s.rowcount} rows): "
+                f"{s.statement}\n" + "\n".join(s.explain or [])
+            )
+    return response
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(request: Request) -> Response:
+    cache = getattr(request.app.state, "response_cache", None)
+    if cache is not None:
+        metrics.CACHE_ENTRIES.set(len(cache))
+
+    engine = getattr(request.app.state, "db_engine", None)
+    if engine is not None:
+        for stat, value in get_pool_stats(engine).items():
+            metrics.POOL_STATS.labels(stat=stat).set(value)
+
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
 app.include_router(base_router, prefix="/api")
 app.include_router(admin_router, prefix="/api/admin", include_in_schema=True)
 
@@ -1,3 +1,22 @@
 from fastapi import APIRouter
 
+from ...db.database import get_pool_stats
+from ..dependencies import TsDbParam
+
 router = APIRouter()
+
+
+@router.get("/cache", tags=["Admin"], name="Get response cache statistics.")
+async def get_cache_stats(db: TsDbParam) -> dict:
+    """
+    Returns size and hit/miss counters of the in-process response cache.
+    """
+    return db.cache.stats() if db.cache is not None else {}
+
+
+@router.get("/pool", tags=["Admin"], name="Get db connection pool statistics.")
+async def get_db_pool_stats(db: TsDbParam) -> dict:
+    """
+    Returns size, checked out connections and saturation of the db pool.
+    """
+    return get_pool_stats(db.engine)
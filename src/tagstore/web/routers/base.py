@@ -1,17 +1,36 @@
 from typing import List, Optional
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
 
 from ....tagpack import __version__
-from ...algorithms.tag_digest import TagDigest, compute_tag_digest
+from ...algorithms.tag_digest import (
+    SubjectTagDigest,
+    TagDigest,
+    compute_tag_digest,
+    compute_tag_digests,
+)
 from ...db import (
     ActorPublic,
     LabelSearchResultPublic,
+    TagExportPublic,
     TagPublic,
+    TagsBySubjectPublic,
+    TagsPagePublic,
     TagstoreStatisticsPublic,
     TaxonomiesPublic,
 )
-from ..dependencies import TsACLGroupsParam, TsDbParam, TsPagingParam, TsTagsQueryParam
+from ..dependencies import (
+    SubjectsQuery,
+    TagsBatchQuery,
+    TsACLGroupsParam,
+    TsCpuExecutorParam,
+    TsCursorPagingParam,
+    TsDbParam,
+    TsPagingParam,
+    TsTagsQueryParam,
+)
 
 router = APIRouter()
 
@@ -21,65 +40,195 @@ async def get_version() -> str:
     return __version__
 
 
-@router.get("/acl_groups", tags=["General"], name="Get acl groups present in the db.")
-async def get_acl_groups(db: TsDbParam) -> List[str]:
+# tags are built from trusted db rows without validation,
+# they are serialized directly instead of via FastAPI's response model.
+_TAG_LIST = TypeAdapter(List[TagPublic])
+_TAGS_BY_SUBJECT_LIST = TypeAdapter(List[TagsBySubjectPublic])
+
+# smaller tag lists are serialized on the event loop, larger ones on the
+# cpu executor
+_INLINE_SERIALIZATION_MAX_TAGS = 1000
+
+
+def _dump_tag_list(tags: List[TagPublic]) -> bytes:
+    return _TAG_LIST.dump_json(tags)
+
+
+def _dump_tags_by_subject_list(results: List[TagsBySubjectPublic]) -> bytes:
+    return _TAGS_BY_SUBJECT_LIST.dump_json(results)
+
+
+def _json_response(data: bytes) -> Response:
+    return Response(content=data, media_type="application/json")
+
+
+@router.get(
+    "/acl_groups",
+    tags=["General"],
+    name="Get acl groups present in the db.",
+    response_model=List[str],
+)
+async def get_acl_groups(db: TsDbParam):
     """
     Loads ACL Groups available in the db..
     """
-    return await db.get_acl_groups()
+    return _json_response(await db.get_acl_groups_json())
 
 
 @router.get(
-    "/taxonomy", tags=["General"], name="Get a labels and description for id values."
+    "/taxonomy",
+    tags=["General"],
+    name="Get a labels and description for id values.",
+    response_model=TaxonomiesPublic,
 )
-async def get_taxonomies(db: TsDbParam) -> TaxonomiesPublic:
+async def get_taxonomies(db: TsDbParam):
     """
     Loads taxonomies (meta information and descriptions) used in this API.
     """
-    return await db.get_taxonomies()
+    return _json_response(await db.get_taxonomies_json())
 
 
 @router.get(
-    "/statistics", tags=["General"], name="Get a per network statistic of tag counts."
+    "/statistics",
+    tags=["General"],
+    name="Get a per network statistic of tag counts.",
+    response_model=TagstoreStatisticsPublic,
 )
-async def get_statistics(db: TsDbParam) -> TagstoreStatisticsPublic:
+async def get_statistics(db: TsDbParam):
     """
     Loads statistics on tag counts in the database.
     """
-    return await db.get_network_statistics_cached()
+    return _json_response(await db.get_network_statistics_cached_json())
 
 
 @router.get(
     "/tags",
     tags=["Tags"],
     name="Get all tags for an query",
+    response_model=List[TagPublic],
 )
 async def get_tags(
     query: TsTagsQueryParam,
     page: TsPagingParam,
     groups: TsACLGroupsParam,
     db: TsDbParam,
-) -> List[TagPublic]:
+    executor: TsCpuExecutorParam,
+):
     """
     Loads tags for a tx hash, address (subject_id),
       label (label), actor (actor_id) or cluster id (cluster_id)
     """
     if query.label is not None:
-        return await db.get_tags_by_label(
+        tags = await db.get_tags_by_label(
             query.label, page.offset, page.limit, groups, network=query.network
         )
     elif query.actor_id is not None:
-        return await db.get_tags_by_actorid(
+        tags = await db.get_tags_by_actorid(
             query.actor_id, page.offset, page.limit, groups, network=query.network
         )
     elif query.subject_id is not None:
-        return await db.get_tags_by_subjectid(
+        tags = await db.get_tags_by_subjectid(
             query.subject_id, page.offset, page.limit, groups, network=query.network
         )
     elif query.cluster_id is not None:
-        return await db.get_tags_by_clusterid(
+        tags = await db.get_tags_by_clusterid(
             query.cluster_id, query.network, page.offset, page.limit, groups
         )
+    if len(tags) <= _INLINE_SERIALIZATION_MAX_TAGS:
+        return _json_response(_dump_tag_list(tags))
+    return _json_response(await executor.run(_dump_tag_list, tags))
+
+
+@router.get(
+    "/tags/paged",
+    tags=["Tags"],
+    name="Get all tags for an query, paged by a next_page token",
+    response_model=TagsPagePublic,
+)
+async def get_tags_paged(
+    query: TsTagsQueryParam,
+    page: TsCursorPagingParam,
+    groups: TsACLGroupsParam,
+    db: TsDbParam,
+):
+    """
+    Same as /tags but pages by a next_page token instead of page numbers,
+      which keeps deep pages cheap. Tags are ordered by confidence.
+    """
+    if query.label is not None:
+        result = await db.get_tags_page_by_label(
+            query.label, page.cursor, page.page_size, groups, network=query.network
+        )
+    elif query.actor_id is not None:
+        result = await db.get_tags_page_by_actorid(
+            query.actor_id, page.cursor, page.page_size, groups, network=query.network
+        )
+    elif query.subject_id is not None:
+        result = await db.get_tags_page_by_subjectid(
+            query.subject_id,
+            page.cursor,
+            page.page_size,
+            groups,
+            network=query.network,
+        )
+    elif query.cluster_id is not None:
+        result = await db.get_tags_page_by_clusterid(
+            query.cluster_id, query.network, page.cursor, page.page_size, groups
+        )
+    return _json_response(result.model_dump_json().encode("utf-8"))
+
+
+@router.post(
+    "/tags/batch",
+    tags=["Tags"],
+    name="Get tags for many subject ids at once",
+    response_model=List[TagsBySubjectPublic],
+)
+async def get_tags_batch(
+    query: TagsBatchQuery,
+    groups: TsACLGroupsParam,
+    db: TsDbParam,
+    executor: TsCpuExecutorParam,
+):
+    """
+    Loads tags for a list of (subject_id, network) pairs in one go,
+      at most page_size tags are returned per subject.
+    """
+    results = await db.get_tags_by_subjectids(
+        query.subject_network_pairs(), query.page_size, groups
+    )
+    return _json_response(await executor.run(_dump_tags_by_subject_list, results))
+
+
+@router.get(
+    "/export/tags",
+    tags=["Export"],
+    name="Export all tags of a network or actor as NDJSON",
+    response_model=TagExportPublic,
+    response_description="One JSON encoded tag per line, ordered by id.",
+)
+async def export_tags(
+    groups: TsACLGroupsParam,
+    db: TsDbParam,
+    network: Optional[str] = None,
+    actor: Optional[str] = None,
+    after_id: Optional[int] = None,
+):
+    """
+    Streams all tags matching network and actor (one tag per line),
+      after_id resumes an export after the last tag id received.
+    """
+
+    async def ndjson_lines():
+        async for tags in db.stream_tags(
+            groups,
+            network=network.upper() if network else None,
+            actor=actor,
+            after_id=after_id,
+        ):
+            yield b"".join(t.model_dump_json().encode("utf-8") + b"\n" for t in tags)
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
 
 
 @router.get(
@@ -91,14 +240,43 @@ async def get_tag_digest(
     subject_id: str,
     groups: TsACLGroupsParam,
     db: TsDbParam,
+    executor: TsCpuExecutorParam,
 ) -> TagDigest:
     """
     Loads tags for a tx hash, address (subject_id),
       label (label), actor (actor_id) or cluster id (cluster_id)
     """
-    return compute_tag_digest(
-        await db.get_tags_by_subjectid(subject_id, None, None, groups)
+    digest = await db.get_tag_digest_json(subject_id, groups)
+    if digest is not None:
+        return _json_response(digest)
+
+    tags = await db.get_tags_by_subjectid(subject_id, None, None, groups)
+    return await executor.run(compute_tag_digest, tags)
+
+
+@router.post(
+    "/tag-digest/batch",
+    tags=["Digest"],
+    name="Get digests of all tags for many tx, addresses or other identifiers",
+)
+async def get_tag_digests_batch(
+    query: SubjectsQuery,
+    groups: TsACLGroupsParam,
+    db: TsDbParam,
+    executor: TsCpuExecutorParam,
+) -> List[SubjectTagDigest]:
+    """
+    Loads the tags of all subjects with one query and computes
+      a digest per subject off the event loop.
+    """
+    results = await db.get_tags_by_subjectids(
+        query.subject_network_pairs(), None, groups
     )
+    digests = await executor.run(compute_tag_digests, [r.tags for r in results])
+    return [
+        SubjectTagDigest(subject_id=r.subject_id, network=r.network, digest=d)
+        for r, d in zip(results, digests)
+    ]
 
 
 @router.get(
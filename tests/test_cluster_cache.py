@@ -0,0 +1,46 @@
+import pandas as pd
+
+from tagpack.cluster_cache import ClusterMappingCache
+
+
+def clusters(addresses):
+    return pd.DataFrame(
+        {
+            "address": addresses,
+            "cluster_id": [i + 100 for i in range(len(addresses))],
+            "cluster_defining_address": addresses,
+            "no_addresses": [1] * len(addresses),
+            "other": [None] * len(addresses),
+        }
+    )
+
+
+def test_cluster_mapping_cache(tmp_path):
+    path = str(tmp_path / "cache" / "mappings.sqlite")
+    cache = ClusterMappingCache(path)
+    cache.use_keyspace("BTC", "btc_transformed_1")
+    cache.use_keyspace("LTC", "ltc_transformed_1")
+
+    addresses = [f"a{i}" for i in range(1200)]
+    cache.put("BTC", clusters(addresses))
+    cache.put("LTC", clusters(["a0"]))
+
+    found = cache.get("BTC", ["a1", "a1100", "unknown"])
+    assert sorted(found["address"]) == ["a1", "a1100"]
+    assert list(found.columns) == ClusterMappingCache.COLUMNS
+    assert len(cache.get("BTC", addresses)) == 1200
+
+    cache.close()
+
+    # entries survive, until the keyspace of their network changes
+    cache = ClusterMappingCache(path)
+    cache.use_keyspace("BTC", "btc_transformed_1")
+    assert len(cache.get("BTC", ["a1"])) == 1
+
+    cache.use_keyspace("BTC", "btc_transformed_2")
+    assert cache.get("BTC", ["a1"]).empty
+
+    cache.use_keyspace("LTC", "ltc_transformed_1")
+    assert len(cache.get("LTC", ["a0"])) == 1
+
+    cache.close()
@@ -0,0 +1,276 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import base58
+import pandas as pd
+import pytest
+from cassandra import OperationTimedOut
+
+from tagpack.graphsense import (
+    AdaptiveConcurrency,
+    ClusterLookupPipeline,
+    _b58decode,
+    address_lookup_parameters,
+    evm_addresses_to_tron,
+    evm_to_tron_address_string,
+    token_range_splits,
+)
+
+KS_CONFIG = {"address_prefix_length": 5, "bech_32_prefix": "bc1"}
+
+TRX_ADDRESS = "TRjE1H8dxypKM1NZRdysbs9wo7huR4bdNz"
+TRX_ADDRESS_EVM = "0xac8a3d1ccc1ea4d3c5a5b4e7d5b4a5e8fe1fea9f"
+
+
+def test_b58decode():
+    for v in ["", "1", "11", TRX_ADDRESS, "11" + TRX_ADDRESS]:
+        assert _b58decode(v) == base58.b58decode(v)
+
+    with pytest.raises(ValueError):
+        _b58decode("0OIl")
+
+
+def test_address_lookup_parameters():
+    tron = evm_to_tron_address_string(TRX_ADDRESS_EVM)
+    upper = "0x" + TRX_ADDRESS_EVM[2:].upper()
+    addresses = pd.Series([tron, upper, "Tinvalid"], index=[3, 4, 5])
+    df = address_lookup_parameters(addresses, "TRX", KS_CONFIG)
+
+    assert list(df.index) == [3, 4]
+    assert list(df["address_prefix"]) == ["AC8A3", "AC8A3"]
+    assert list(df["address"]) == [bytes.fromhex(TRX_ADDRESS_EVM[2:])] * 2
+
+    addresses = pd.Series(["0xAbCdEf0123", "0xnothex"])
+    df = address_lookup_parameters(addresses, "ETH", KS_CONFIG)
+
+    assert list(df["address_prefix"]) == ["ABCDE"]
+    assert list(df["address"]) == [bytes.fromhex("abcdef0123")]
+
+    addresses = pd.Series(["bc1qxyz123456", "1Archive1n2C579dMsAu3iC6tWzuQJz8dN"])
+    df = address_lookup_parameters(addresses, "BTC", KS_CONFIG)
+
+    assert list(df["address_prefix"]) == ["qxyz1", "1Arch"]
+    assert list(df["address"]) == list(addresses)
+
+
+def test_evm_addresses_to_tron():
+    evm = bytes.fromhex(TRX_ADDRESS_EVM[2:])
+    tron = evm_to_tron_address_string(TRX_ADDRESS_EVM)
+
+    assert evm_addresses_to_tron([evm]) == [tron]
+    assert evm_addresses_to_tron([evm], known={evm: "known"}) == ["known"]
+
+
+def test_token_range_splits():
+    splits = token_range_splits(7)
+
+    assert len(splits) == 7
+    assert splits[0][0] == -(2**63)
+    assert splits[-1][1] == 2**63 - 1
+    assert all(a[1] == b[0] for a, b in zip(splits, splits[1:]))
+
+
+class FakeFuture:
+    def __init__(self, executor, rows, latency=0):
+        self.executor = executor
+        self.rows = rows
+        self.latency = latency
+
+    def add_callbacks(self, callback, errback, callback_args=(), errback_args=()):
+        def complete():
+            if self.latency:
+                time.sleep(self.latency)
+            if isinstance(self.rows, Exception):
+                errback(self.rows, *errback_args)
+            else:
+                callback(self.rows, *callback_args)
+
+        if self.executor is None:
+            complete()
+        else:
+            self.executor.submit(complete)
+
+
+class FakeSession:
+    """Answers the lookups of ClusterLookupPipeline, "<kind> in" statements
+    are IN lookups."""
+
+    def __init__(self, executor=None, fail_on=None, time_out_first=False, latency=0):
+        self.executor = executor
+        self.fail_on = fail_on
+        self.time_out_first = time_out_first
+        self.latency = latency
+        self.queries = []
+        self.lock = threading.Lock()
+        # address i has address id i, addresses 0-9 are in cluster 100, the
+        # others form their own cluster 1000 + i
+        self.tables = {
+            "address_id": lambda p: [{"address": p[1], "address_id": int(p[1])}],
+            "cluster_id": lambda p: [
+                {"address_id": p[1], "cluster_id": 100 if p[1] < 10 else 1000 + p[1]}
+            ],
+            "cluster": lambda p: [{"cluster_id": p[1], "no_addresses": 1}],
+            "cluster_definer": lambda p: [
+                {"cluster_id": p[1], "cluster_defining_address": str(p[1])}
+            ],
+        }
+
+    def execute_async(self, statement, params):
+        with self.lock:
+            first = self.time_out_first and (statement, params) not in self.queries
+            self.queries.append((statement, params))
+        if first:
+            return FakeFuture(self.executor, OperationTimedOut("timed out"))
+        if statement == self.fail_on:
+            return FakeFuture(self.executor, ValueError("query failed"))
+        if statement.endswith(" in"):
+            lookup = self.tables[statement[:-3]]
+            partition, keys = params
+            rows = [row for key in keys for row in lookup((partition, key))]
+        else:
+            rows = self.tables[statement](params)
+        return FakeFuture(self.executor, rows, self.latency)
+
+
+def run_pipeline(session, grouped=False, n=1000, concurrency=5):
+    statements = {k: k for k in session.tables}
+    in_statements = {k: f"{k} in" for k in session.tables} if grouped else None
+    pipeline = ClusterLookupPipeline(
+        session,
+        statements,
+        10,
+        AdaptiveConcurrency(1, concurrency, initial=concurrency),
+        in_statements,
+    )
+    pipeline.run([str(i)[:1] for i in range(n)], [str(i) for i in range(n)])
+    return pipeline
+
+
+@pytest.mark.parametrize("threaded", [False, True])
+def test_cluster_lookup_pipeline(threaded):
+    executor = ThreadPoolExecutor(4) if threaded else None
+    session = FakeSession(executor)
+    pipeline = run_pipeline(session)
+
+    assert len(pipeline.address_ids) == 1000
+    assert len(pipeline.cluster_ids) == 1000
+    # cluster 100 is looked up once
+    assert len(pipeline.clusters) == 991
+    assert len(pipeline.cluster_definers) == 991
+    assert ("cluster", (10, 100)) in session.queries
+    assert ("cluster_id", (99, 999)) in session.queries
+
+    if executor is not None:
+        executor.shutdown()
+
+
+def test_cluster_lookup_pipeline_error():
+    session = FakeSession(fail_on="cluster")
+
+    with pytest.raises(ValueError, match="query failed"):
+        run_pipeline(session)
+
+    # no new addresses are looked up after the failure
+    assert len([q for q in session.queries if q[0] == "address_id"]) < 1000
+
+
+def test_cluster_lookup_pipeline_retries():
+    session = FakeSession(time_out_first=True)
+    pipeline = run_pipeline(session, n=20, concurrency=64)
+
+    # every query timed out once and was retried
+    assert pipeline.retries == 20 + 20 + 11 + 11
+    assert len(pipeline.address_ids) == 20
+    assert len(pipeline.clusters) == 11
+    assert pipeline._concurrency.current < 64
+
+
+@pytest.mark.parametrize("threaded", [False, True])
+def test_cluster_lookup_pipeline_grouped(threaded):
+    executor = ThreadPoolExecutor(4) if threaded else None
+    session = FakeSession(executor)
+    pipeline = run_pipeline(session, grouped=True)
+
+    assert len(pipeline.address_ids) == 1000
+    assert len(pipeline.cluster_ids) == 1000
+    assert len(pipeline.clusters) == 991
+    assert len(pipeline.cluster_definers) == 991
+    # addresses are grouped by their first digit, i.e. into partitions of
+    # 111 addresses (2 IN queries each) and "0" (a point query)
+    address_queries = [q for q in session.queries if q[0] == "address_id in"]
+    assert len(address_queries) == 18
+    assert ("address_id", ("0", "0")) in session.queries
+    assert len(session.queries) < 4 * 1000 / 2
+
+    if executor is not None:
+        executor.shutdown()
+
+
+def test_adaptive_concurrency():
+    c = AdaptiveConcurrency(4, 20, initial=10)
+
+    # grows by about one per window while the window is used
+    for _ in range(10):
+        c.on_success(0.01, in_flight=10)
+    assert c.current == 10
+    assert c.limit > 10.9
+
+    # not when the window is not used
+    limit = c.limit
+    c.on_success(0.01, in_flight=1)
+    assert c.limit == limit
+
+    # is cut once per window on overload
+    c.on_overload()
+    assert c.current == 5
+    c.on_overload()
+    assert c.current == 5
+
+    # and when latency grows
+    for _ in range(10):
+        c.on_success(0.1, in_flight=5)
+    assert c.current == 4
+
+    for _ in range(10_000):
+        c.on_success(0.01, in_flight=20)
+    assert c.current == 20
+
+    with pytest.raises(ValueError):
+        AdaptiveConcurrency(10, 5)
+
+
+@pytest.mark.slow
+def test_benchmark_grouped_lookups():
+    # simulated cluster: 16 queries served in parallel, 1ms each
+    for grouped in [False, True]:
+        with ThreadPoolExecutor(16) as executor:
+            session = FakeSession(executor, latency=0.001)
+            t0 = time.perf_counter()
+            pipeline = run_pipeline(session, grouped, n=5000, concurrency=64)
+            duration = time.perf_counter() - t0
+
+        print(f"\ngrouped={grouped}: {len(session.queries)} queries, {duration:.2f}s")
+        assert len(pipeline.address_ids) == 5000
+
+
+@pytest.mark.slow
+def test_benchmark_address_lookup_parameters():
+    n = 100_000
+    inputs = {
+        "ETH": ["0x" + os.urandom(20).hex() for _ in range(n)],
+        "TRX": [
+            evm_to_tron_address_string("0x" + os.urandom(20).hex()) for _ in range(n)
+        ],
+        "BTC": ["bc1q" + os.urandom(19).hex() for _ in range(n)],
+    }
+
+    for network, addresses in inputs.items():
+        addresses = pd.Series(addresses)
+        t0 = time.perf_counter()
+        df = address_lookup_parameters(addresses, network, KS_CONFIG)
+        duration = time.perf_counter() - t0
+
+        print(f"\n{network}: {n / duration:,.0f} addresses/s")
+        assert len(df) == n
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+
+import pytest
+
+from tagstore.db.cache import ResponseCache
+from tagstore.metrics import (
+    CACHE_HITS,
+    CACHE_MISSES,
+    CPU_EXECUTOR_QUEUE_DEPTH,
+    Counter,
+    Gauge,
+    Histogram,
+    Registry,
+)
+from tagstore.web.executor import CpuBoundExecutor
+
+
+def test_metrics_rendering():
+    registry = Registry()
+    c = registry.register(Counter("requests", "Requests.", labelnames=("route",)))
+    g = registry.register(Gauge("in_flight", "In flight."))
+    h = registry.register(Histogram("latency", "Latency.", buckets=(0.1, 1)))
+
+    c.labels(route="/api/tags").inc()
+    c.labels(route="/api/tags").inc(2)
+    g.inc()
+    g.inc()
+    g.dec()
+    h.observe(0.05)
+    h.observe(0.5)
+    h.observe(5)
+
+    lines = registry.render().splitlines()
+
+    assert "# TYPE requests counter" in lines
+    assert 'requests_total{route="/api/tags"} 3.0' in lines
+    assert "in_flight 1.0" in lines
+    assert 'latency_bucket{le="0.1"} 1' in lines
+    assert 'latency_bucket{le="1.0"} 2' in lines
+    assert 'latency_bucket{le="+Inf"} 3' in lines
+    assert "latency_count 3" in lines
+
+    with pytest.raises(ValueError):
+        c.labels(route="/api/tags").inc(-1)
+
+
+def test_response_cache_counters():
+    hits, misses = CACHE_HITS.labels().value, CACHE_MISSES.labels().value
+    cache = ResponseCache()
+    cache.set("a", b"1")
+    cache.get("a")
+    cache.get("b")
+
+    assert CACHE_HITS.labels().value == hits + 1
+    assert CACHE_MISSES.labels().value == misses + 1
+
+
+@pytest.mark.asyncio
+async def test_cpu_executor_queue_depth():
+    executor = CpuBoundExecutor(1)
+    release = threading.Event()
+
+    def work(x):
+        release.wait(5)
+        return x * 2
+
+    tasks = [asyncio.create_task(executor.run(work, i)) for i in range(3)]
+    await asyncio.sleep(0.1)
+
+    assert executor.pending == 3
+    assert executor.queue_depth == 2
+    assert CPU_EXECUTOR_QUEUE_DEPTH.labels().value == 2
+
+    release.set()
+
+    assert await asyncio.gather(*tasks) == [0, 2, 4]
+    assert executor.queue_depth == 0
+    assert CPU_EXECUTOR_QUEUE_DEPTH.labels().value == 0
+
+    executor.shutdown()
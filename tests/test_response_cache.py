@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from tagstore.db.cache import ResponseCache, SingleFlight
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_ttl():
+    clock = FakeClock()
+    cache = ResponseCache(ttl=10, max_entries=5, clock=clock)
+
+    assert cache.get(("a",)) is None
+    cache.set(("a",), b"1")
+    assert cache.get(("a",)) == b"1"
+
+    clock.now = 11
+    assert cache.get(("a",)) is None
+    assert len(cache) == 0
+
+    assert cache.hits == 1
+    assert cache.misses == 2
+
+
+def test_cache_lru_eviction():
+    cache = ResponseCache(ttl=10, max_entries=2)
+
+    cache.set(("a",), b"1")
+    cache.set(("b",), b"2")
+    # touch a, so b is the least recently used entry
+    assert cache.get(("a",)) == b"1"
+    cache.set(("c",), b"3")
+
+    assert cache.get(("b",)) is None
+    assert cache.get(("a",)) == b"1"
+    assert cache.get(("c",)) == b"3"
+
+
+def test_cache_invalidation():
+    cache = ResponseCache()
+
+    cache.set(("get_taxonomies_json", ()), b"1")
+    cache.set(("get_acl_groups_json", ()), b"2")
+
+    cache.invalidate("get_acl_groups_json")
+    assert cache.get(("get_acl_groups_json", ())) is None
+    assert cache.get(("get_taxonomies_json", ())) == b"1"
+
+    cache.invalidate()
+    assert len(cache) == 0
+    assert cache.stats()["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    sf = SingleFlight()
+    calls = []
+
+    async def work(x):
+        calls.append(x)
+        await asyncio.sleep(0.05)
+        return [x]
+
+    results = await asyncio.gather(
+        sf.do(("a", 1), lambda: work(1)),
+        sf.do(("a", 1), lambda: work(1)),
+        sf.do(("a", 2), lambda: work(2)),
+    )
+
+    assert results == [[1], [1], [2]]
+    assert calls == [1, 2]
+    assert sf.stats() == {"in_flight": 0, "calls": 2, "coalesced": 1}
+
+    # finished calls are not cached
+    assert await sf.do(("a", 1), lambda: work(1)) == [1]
+    assert calls == [1, 2, 1]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_errors_and_cancellation():
+    sf = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.05)
+        raise ValueError("boom")
+
+    results = await asyncio.gather(
+        sf.do("k", fail), sf.do("k", fail), return_exceptions=True
+    )
+    assert all(isinstance(r, ValueError) for r in results)
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        return 42
+
+    first = asyncio.create_task(sf.do("s", slow))
+    second = asyncio.create_task(sf.do("s", slow))
+    await asyncio.sleep(0.01)
+    first.cancel()
+
+    assert await second == 42
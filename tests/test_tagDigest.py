@@ -1,8 +1,25 @@
 import json
+import random
+import re
+import string
+import time
+from collections import Counter, defaultdict
 
 import pytest
 
-from tagstore.algorithms.tag_digest import compute_tag_digest
+from tagstore.algorithms.tag_digest import (
+    _FILTER_WORDS,
+    LabelDigest,
+    TagDigest,
+    _calcTagCloud,
+    _frequent_words_in,
+    _get_concept_weight,
+    _map_concept_to_broad_concept,
+    _tokenize_label,
+    compute_tag_digest,
+    wCounter,
+)
+from tagstore.db import InheritedFrom
 from tagstore.db.queries import TagPublic
 
 
@@ -107,3 +124,184 @@ def test_tag_digest_exchange(tagsExchange):
 
     assert list(digest.concept_tag_cloud.keys())[0] == "exchange"
     assert list(digest.concept_tag_cloud.keys()) == ["exchange"]
+
+
+def _nested_scan(labels, word_counts):
+    # relevance multipliers as computed before the substring index
+    return {
+        lbl: sum(
+            occurrence
+            for word, occurrence in word_counts.most_common()
+            if word in lbl and occurrence > 1
+        )
+        for lbl in labels
+    }
+
+
+def _many_tags(template, nr_tags, nr_labels, nr_words=2_000, seed=42):
+    rnd = random.Random(seed)
+    words = [
+        "".join(rnd.choice(string.ascii_letters) for _ in range(rnd.randint(2, 10)))
+        for _ in range(nr_words)
+    ]
+    labels = [
+        " ".join(rnd.choice(words) for _ in range(rnd.randint(1, 4)))
+        + f" {rnd.randint(0, 99)}"
+        for _ in range(nr_labels)
+    ]
+    return [
+        TagPublic(
+            **{
+                **template.model_dump(),
+                "label": rnd.choice(labels),
+                "actor": rnd.choice([None, "binance", "cryptodogs"]),
+                "confidence_level": rnd.choice([10, 50, 100]),
+                "primary_concept": rnd.choice([None, "exchange", "defi"]),
+            }
+        )
+        for _ in range(nr_tags)
+    ]
+
+
+def _compute_tag_digest_before(tags):
+    # compute_tag_digest before the label tokens were cached and the
+    # relevance multipliers computed via the substring index
+    def normalize(istr):
+        return re.sub(" +", " ", re.sub(r"[^0-9a-zA-Z_ ]+", " ", istr.strip().lower()))
+
+    tags_count = 0
+    total_words = 0
+    tags_count_cluster = 0
+    actor_counter = wCounter()
+    label_word_counter = wCounter()
+    full_label_counter = wCounter()
+    concepts_counter = wCounter()
+    actor_labels = defaultdict(wCounter)
+    label_summary = defaultdict(
+        lambda: {
+            "cnt": 0,
+            "lbl": None,
+            "src": set(),
+            "sumConfidence": 0,
+            "creators": set(),
+            "concepts": set(),
+            "lastmod": 0,
+            "inherited": False,
+        }
+    )
+
+    for t in tags:
+        conf = t.confidence_level or 0.1
+        tags_count += 1
+        if t.inherited_from == InheritedFrom.CLUSTER:
+            tags_count_cluster += 1
+
+        norm_words = [normalize(w) for w in normalize(t.label).split(" ")]
+        filtered_words = [w for w in norm_words if w not in _FILTER_WORDS]
+        total_words += len(filtered_words)
+        label_word_counter.update(Counter(filtered_words))
+
+        nlabel = normalize(t.label)
+        ls = label_summary[nlabel]
+        full_label_counter.add(nlabel, conf)
+
+        if t.actor:
+            actor_labels[t.actor].add(nlabel, weight=conf)
+            actor_counter.add(t.actor, weight=conf)
+
+        for x in t.concepts or ["unknown"]:
+            concepts_counter.add(x, weight=conf * _get_concept_weight(x))
+            ls["concepts"].add(x)
+
+        ls["cnt"] += 1
+        ls["lbl"] = t.label
+        ls["src"].add(t.source)
+        ls["creators"].add(t.creator)
+        ls["sumConfidence"] += conf
+        ls["lastmod"] = max(ls["lastmod"], t.lastmod)
+        ls["inherited"] = t.inherited_from == InheritedFrom.CLUSTER and ls["inherited"]
+
+    sw_full_label_counter = wCounter()
+    for lbl, v in full_label_counter.most_common(weighted=True):
+        multiplier = sum(
+            occurrence
+            for word, occurrence in label_word_counter.most_common()
+            if word in lbl and occurrence > 1
+        )
+        n = 1 + multiplier / total_words if total_words > 0 else 1
+        sw_full_label_counter.add(lbl, v * n)
+
+    ltc = _calcTagCloud(sw_full_label_counter)
+    label_digest = {
+        key: LabelDigest(
+            label=value["lbl"],
+            count=value["cnt"],
+            confidence=value["sumConfidence"] / (value["cnt"] * 100),
+            relevance=ltc[key].weighted,
+            creators=list(value["creators"]),
+            sources=list(value["src"]),
+            concepts=list(value["concepts"]),
+            lastmod=value["lastmod"],
+            inherited_from="cluster" if value["inherited"] else None,
+        )
+        for (key, value) in label_summary.items()
+    }
+
+    broad_concept = "entity"
+    if len(concepts_counter) > 0:
+        broad_concept = _map_concept_to_broad_concept(
+            concepts_counter.most_common(1, weighted=True)[0][0]
+        )
+
+    p_actor = None
+    best_label = None
+    actor_mc = actor_counter.most_common(1, weighted=True)
+    if len(actor_mc) > 0:
+        p_actor = actor_mc[0][0]
+        key = actor_labels[p_actor].most_common(1, weighted=True)[0][0]
+        best_label = label_digest[key].label
+    elif len(full_label_counter) > 0:
+        key = full_label_counter.most_common(1, weighted=True)[0][0]
+        best_label = label_digest[key].label
+
+    return TagDigest(
+        broad_concept=broad_concept,
+        nr_tags=tags_count,
+        nr_tags_indirect=tags_count_cluster,
+        best_actor=p_actor,
+        best_label=best_label,
+        concept_tag_cloud=_calcTagCloud(concepts_counter),
+        label_digest=label_digest,
+    )
+
+
+def test_frequent_words_in(tagsCryptoDogs, tagsExchange):
+    for tags in [tagsCryptoDogs, tagsExchange]:
+        tokens = [_tokenize_label(t.label) for t in tags]
+        word_counts = Counter(w for _, words in tokens for w in words)
+        labels = {nlabel for nlabel, _ in tokens}
+
+        assert _frequent_words_in(labels, word_counts) == _nested_scan(
+            labels, word_counts
+        )
+
+
+@pytest.mark.slow
+def test_benchmark_tag_digest_10k(tagsExchange):
+    tags = _many_tags(tagsExchange[0], 10_000, 5_000)
+
+    t0 = time.perf_counter()
+    expected = _compute_tag_digest_before(tags)
+    t_before = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    digest = compute_tag_digest(tags)
+    t_digest = time.perf_counter() - t0
+
+    print(
+        f"\n10k tags: digest before {t_before * 1000:.1f}ms, "
+        f"now {t_digest * 1000:.1f}ms"
+    )
+
+    assert digest == expected
+    assert digest.nr_tags == 10_000
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
+import pandas as pd
+import psycopg2
 import pytest
+from tagpack import cli
 from tagpack.tagstore import _perform_address_modifications, TagStore
 
+from tagstore.algorithms.tag_digest import compute_tag_digest
+from tagstore.cli.main import materialize_tag_digests
 from tagstore.db import TagstoreDbAsync
 from tagstore.db.queries import UserReportedAddressTag
 from tagstore.db import TagAlreadyExistsException
+from tagstore.db import TagsCursor
+from tagstore.db.tracing import install_sql_tracing, sql_trace
 
 
 def test_bch_conversion():
@@ -170,3 +177,286 @@ async def test_insert_user_tag(db_setup):
     assert len(taxonomiesAfter.tag_subject) == len(taxonomiesBefore.tag_subject)
     assert len(taxonomiesAfter.country) == len(taxonomiesBefore.country)
     assert len(taxonomiesAfter.confidence) == len(taxonomiesBefore.confidence)
+
+
+@pytest.mark.asyncio
+async def test_tags_by_subjectids(db_setup):
+    db = TagstoreDbAsync.from_url(db_setup["db_connection_string_async"])
+
+    subjects = [("1bacdeddg32dsfk5692dmn23", "BTC"), ("0xdeadbeef", None), ("unknown-address", None)]
+
+    res = await db.get_tags_by_subjectids(subjects, page_size=None, groups=['private', 'public'])
+
+    assert [(x.subject_id, x.network) for x in res] == subjects
+    assert len(res[0].tags) == 5
+    assert len(res[1].tags) == 1
+    assert len(res[2].tags) == 0
+    assert {t.identifier for t in res[0].tags} == {"1bacdeddg32dsfk5692dmn23"}
+
+    single = await db.get_tags_by_subjectid("1bacdeddg32dsfk5692dmn23", offset=None, page_size=None, groups=['private', 'public'])
+    assert sorted(t.label for t in res[0].tags) == sorted(t.label for t in single)
+
+    res_limited = await db.get_tags_by_subjectids(subjects, page_size=2, groups=['public'])
+
+    assert len(res_limited[0].tags) == 2
+    assert len(res_limited[1].tags) == 0
+    levels = [t.confidence_level for t in res_limited[0].tags]
+    assert levels == sorted(levels, reverse=True)
+
+
+def test_tags_cursor_roundtrip():
+    c = TagsCursor(level=60, tag_id=12345)
+    token = c.encode()
+
+    assert TagsCursor.decode(token) == c
+
+    with pytest.raises(ValueError):
+        TagsCursor.decode("not-a-token")
+
+
+@pytest.mark.asyncio
+async def test_tags_keyset_paging(db_setup):
+    db = TagstoreDbAsync.from_url(db_setup["db_connection_string_async"])
+    groups = ['private', 'public']
+    subject = "1bacdeddg32dsfk5692dmn23"
+
+    all_tags = await db.get_tags_by_subjectid(subject, offset=None, page_size=None, groups=groups)
+
+    paged = []
+    cursor = None
+    while True:
+        page = await db.get_tags_page_by_subjectid(subject, cursor, 2, groups)
+        paged.extend(page.tags)
+        if page.next_page is None:
+            break
+        cursor = TagsCursor.decode(page.next_page)
+
+    assert [(t.label, t.source) for t in paged] == [(t.label, t.source) for t in all_tags]
+
+    offset_pages = []
+    for nr in range(3):
+        offset_pages.extend(await db.get_tags_by_subjectid(subject, offset=nr * 2, page_size=2, groups=groups))
+
+    assert [(t.label, t.source) for t in offset_pages] == [(t.label, t.source) for t in paged]
+
+
+@pytest.mark.asyncio
+async def test_stream_tags(db_setup):
+    db = TagstoreDbAsync.from_url(db_setup["db_connection_string_async"])
+    groups = ['private', 'public']
+
+    batches = [b async for b in db.stream_tags(groups, network="BTC", batch_size=2)]
+    tags = [t for b in batches for t in b]
+
+    assert len(tags) > 2
+    assert all(len(b) <= 2 for b in batches)
+    assert [t.id for t in tags] == sorted({t.id for t in tags})
+    assert {t.network for t in tags} == {"BTC"}
+
+    resumed = [t async for b in db.stream_tags(groups, network="BTC", after_id=tags[1].id) for t in b]
+
+    assert [t.id for t in resumed] == [t.id for t in tags[2:]]
+
+
+@pytest.mark.asyncio
+async def test_sql_tracing(db_setup):
+    db = TagstoreDbAsync.from_url(db_setup["db_connection_string_async"])
+    install_sql_tracing(db.engine, slow_query_threshold=0)
+    groups = ['private', 'public']
+
+    with sql_trace("GET /api/tags?label=test", explain=True) as trace:
+        tags = await db.get_tags_by_label("tag", 0, 10, groups)
+
+    assert len(tags) > 0
+    assert len(trace.statements) > 0
+    assert trace.duration > 0
+    assert all(s.explain for s in trace.statements if s.statement.startswith("SELECT"))
+
+    with sql_trace("GET /api/tags?label=test") as trace:
+        await db.get_tags_by_label("tag", 0, 10, groups)
+
+    assert all(s.explain is None for s in trace.statements)
+
+
+@pytest.mark.asyncio
+async def test_cluster_tags(db_setup):
+    ts = TagStore(db_setup["db_connection_string"], 'public')
+    db = TagstoreDbAsync.from_url(db_setup["db_connection_string_async"])
+    groups = ['private', 'public']
+    address = "1bacdeddg32dsfk5692dmn23"
+
+    def map_to_cluster(cluster_id):
+        ts.insert_cluster_mappings(pd.DataFrame([{
+            "address": address,
+            "network": "BTC",
+            "cluster_id": cluster_id,
+            "cluster_defining_address": address,
+            "no_addresses": 1,
+        }]))
+
+    map_to_cluster(4242)
+
+    by_subject = await db.get_tags_by_subjectid(address, None, None, groups)
+    by_cluster = await db.get_tags_by_clusterid(4242, "BTC", None, None, groups)
+
+    assert sorted(t.label for t in by_cluster) == sorted(t.label for t in by_subject)
+    assert await db.get_nr_tags_by_clusterid(4242, "BTC", groups) == len(by_subject)
+    assert await db.get_nr_tags_by_clusterid(4242, "BTC", ['private']) == 0
+    assert await db.get_tags_by_clusterid(4242, "BTC", None, None, groups, exclude_identifiers=[address]) == []
+
+    tag = UserReportedAddressTag(address=address, network="Btc", actor='binance', label="cluster-tag-test", description="")
+    await db.add_user_reported_tag(tag)
+
+    assert "cluster-tag-test" in await db.get_labels_by_clusterid(4242, groups)
+    assert await db.get_nr_tags_by_clusterid(4242, "BTC", groups) == len(by_subject) + 1
+
+    map_to_cluster(4243)
+
+    assert await db.get_nr_tags_by_clusterid(4242, "BTC", groups) == 0
+    assert await db.get_nr_tags_by_clusterid(4243, "BTC", groups) == len(by_subject) + 1
+
+    ts.rebuild_cluster_tags()
+
+    assert await db.get_nr_tags_by_clusterid(4243, "BTC", groups) == len(by_subject) + 1
+
+
+@pytest.mark.asyncio
+async def test_materialized_tag_digests(db_setup):
+    db = TagstoreDbAsync.from_url(db_setup["db_connection_string_async"])
+    groups = ['public']
+    address = "1bacdeddg32dsfk5692dmn23"
+
+    assert await materialize_tag_digests(db, groups, only_missing=False) > 0
+    assert await materialize_tag_digests(db, groups) == 0
+
+    stored = await db.get_tag_digest_json(address, groups)
+    live = compute_tag_digest(await db.get_tags_by_subjectid(address, None, None, groups))
+
+    assert stored == live.model_dump_json().encode("utf-8")
+    assert await db.get_tag_digest_json(address, ['public', 'private']) is None
+
+    tag = UserReportedAddressTag(address=address, network="Btc", actor='binance', label="digest-test", description="")
+    await db.add_user_reported_tag(tag)
+
+    assert await db.get_tag_digest_json(address, groups) is None
+    assert await materialize_tag_digests(db, groups) == 1
+    assert await db.get_tag_digest_json(address, groups) is not None
+
+
+def test_address_key_ranges(db_setup):
+    ts = TagStore(db_setup["db_connection_string"], 'public')
+    addresses = sorted(a for a, n in ts.get_addresses(update_existing=True) if n == "BTC")
+
+    ranges = list(ts.get_address_key_ranges("BTC", True, batch_size=1))
+    assert ranges == [(a, a) for a in addresses]
+
+    ranges = list(ts.get_address_key_ranges("BTC", True, batch_size=10))
+    assert ranges == [(addresses[0], addresses[-1])]
+
+    in_range = ts.get_addresses_in_range("BTC", *ranges[0], update_existing=True)
+    assert sorted(a for a, _ in in_range) == addresses
+
+    assert list(ts.get_address_key_ranges("ETH", True, batch_size=10)) == []
+
+    # closing early closes the server side cursor and ends its transaction
+    ranges = ts.get_address_key_ranges("BTC", True, batch_size=1)
+    next(ranges)
+    ranges.close()
+    assert ts.conn.status == psycopg2.extensions.STATUS_READY
+
+
+def test_network_addresses(db_setup):
+    ts = TagStore(db_setup["db_connection_string"], 'public')
+    addresses = sorted(a for a, n in ts.get_addresses(update_existing=True) if n == "BTC")
+
+    assert ts.get_addresses_count("BTC", True) == len(addresses)
+    assert sorted(ts.iter_network_addresses("BTC", True, batch_size=1)) == addresses
+
+    found = ts.filter_network_addresses("BTC", addresses[:1] + ["unknown"], True)
+    assert found == {addresses[0]}
+
+
+def test_mapping_run_status(db_setup):
+    ts = TagStore(db_setup["db_connection_string"], 'public')
+    addresses = sorted(a for a, n in ts.get_addresses(update_existing=True) if n == "BTC")
+    mapped, failed = addresses[:1], addresses[1:2]
+
+    run_id = ts.start_mapping_run(update_existing=True)
+    assert ts.get_unfinished_mapping_run() == (run_id, True)
+
+    ts.set_address_mapping_status(run_id, "BTC", mapped, "mapped")
+    ts.set_address_mapping_status(run_id, "BTC", failed, "failed", error="timeout")
+    ts.add_mapping_checkpoint(run_id, "BTC", mapped[0], mapped[0], "done", 1)
+    ts.add_mapping_checkpoint(run_id, "BTC", failed[0], failed[0], "failed", 0)
+    assert ts.get_mapping_checkpoints(run_id, "BTC") == {(mapped[0], mapped[0])}
+
+    # only pending and failed addresses are left to map in the run
+    pending = sorted(ts.iter_network_addresses("BTC", True, run_id=run_id))
+    assert pending == addresses[1:]
+    assert ts.get_addresses_count("BTC", True, run_id) == len(addresses) - 1
+
+    # the run stays open while addresses or batches failed
+    assert ts.finish_mappings_update(run_id) == (1, 1)
+    assert ts.get_unfinished_mapping_run() == (run_id, True)
+
+    ts.set_address_mapping_status(run_id, "BTC", failed, "mapped")
+    ts.cursor.execute(
+        "SELECT attempts, error FROM address_mapping_status WHERE address = %s",
+        (failed[0],),
+    )
+    assert ts.cursor.fetchone() == (2, None)
+
+    ts.mark_unmapped_not_found(run_id, "BTC", True)
+    assert ts.get_addresses_count("BTC", True, run_id) == 0
+    assert ts.finish_mappings_update(run_id) == (0, 1)
+
+    # a failed token range without addresses keeps the run open as well
+    ts.delete_failed_mapping_checkpoints(run_id, "BTC")
+    ts.add_mapping_checkpoint(run_id, "BTC", -10, 10, "failed", 0)
+    assert ts.finish_mappings_update(run_id) == (0, 1)
+    ts.add_mapping_checkpoint(run_id, "BTC", -10, 10, "done", 0)
+
+    # and so do batches left to process
+    assert ts.finish_mappings_update(run_id, complete=False) == (0, 0)
+    assert ts.get_unfinished_mapping_run() == (run_id, True)
+
+    assert ts.finish_mappings_update(run_id) == (0, 0)
+    assert ts.get_unfinished_mapping_run() is None
+    assert ts.get_addresses_count("BTC", False) == 0
+
+    ts.cursor.execute("UPDATE address SET is_mapped = false")
+    ts.conn.commit()
+
+
+class MissingKeyspaces:
+    def keyspace_for_network_exists(self, network):
+        return False
+
+
+def test_mapping_run_missing_keyspace(db_setup, monkeypatch):
+    ts = TagStore(db_setup["db_connection_string"], "public")
+    addresses = sorted(
+        a for a, n in ts.get_addresses(update_existing=True) if n == "BTC"
+    )
+    monkeypatch.setattr(cli, "_mapping_worker_connections", (ts, MissingKeyspaces()))
+
+    run_id = ts.start_mapping_run(update_existing=True)
+    first, last = addresses[0], addresses[-1]
+    # not counted as failed batches, the other networks are still mapped
+    result = cli.insert_cluster_mapping_wp("BTC", first, last, True, run_id)
+    assert result == ("BTC", 0, False)
+    result = cli.scan_cluster_mapping_wp("BTC", -10, 10, True, run_id)
+    assert result == ("BTC", 0, False)
+
+    # but the run stays open and the addresses are retried on resume
+    assert ts.finish_mappings_update(run_id) == (len(addresses), 2)
+    assert ts.get_unfinished_mapping_run() == (run_id, True)
+    assert ts.get_addresses_count("BTC", True, run_id) == len(addresses)
+
+    ts.set_address_mapping_status(run_id, "BTC", addresses, "not_found")
+    ts.delete_failed_mapping_checkpoints(run_id, "BTC")
+    assert ts.finish_mappings_update(run_id) == (0, 0)
+    assert ts.get_unfinished_mapping_run() is None
+
+    ts.cursor.execute("UPDATE address SET is_mapped = false")
+    ts.conn.commit()
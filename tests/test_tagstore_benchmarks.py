@@ -0,0 +1,158 @@
+import json
+import time
+from typing import List
+
+import psycopg2
+import pytest
+from fastapi.encoders import jsonable_encoder
+from psycopg2.extras import execute_values
+from pydantic import TypeAdapter
+from sqlalchemy import desc
+from sqlalchemy.orm import joinedload
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from tagstore.db import TagPublic, TagstoreDbAsync
+from tagstore.db.models import Confidence, Tag, TagPack
+
+BENCH_TAGPACK = "bench-many-concepts"
+BENCH_ADDRESS = "bench-many-concepts-address"
+NR_TAGS = 5000
+NR_CONCEPTS = 30
+
+
+@pytest.fixture(scope="module")
+def many_concepts_db(db_setup):
+    conn = psycopg2.connect(db_setup["db_connection_string"])
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM concept ORDER BY id LIMIT %s", (NR_CONCEPTS,))
+    concepts = [x for (x,) in cur.fetchall()]
+
+    cur.execute(
+        "INSERT INTO tagpack (id, title, description, creator, uri, acl_group) "
+        "VALUES (%s, 'bench', 'bench', 'bench', NULL, 'public')",
+        (BENCH_TAGPACK,),
+    )
+    tag_ids = execute_values(
+        cur,
+        "INSERT INTO tag (label, source, identifier, network, confidence, "
+        "tagpack, tag_type, tag_subject) VALUES %s RETURNING id",
+        [
+            (
+                f"bench label {i}",
+                "bench",
+                BENCH_ADDRESS,
+                "BTC",
+                "unknown",
+                BENCH_TAGPACK,
+                "actor",
+                "address",
+            )
+            for i in range(NR_TAGS)
+        ],
+        fetch=True,
+        page_size=1000,
+    )
+    execute_values(
+        cur,
+        "INSERT INTO tag_concept (tag_id, concept_id) VALUES %s",
+        [(tag_id, c) for (tag_id,) in tag_ids for c in concepts],
+        page_size=10000,
+    )
+    conn.commit()
+
+    yield db_setup
+
+    cur.execute("DELETE FROM tagpack WHERE id = %s", (BENCH_TAGPACK,))
+    conn.commit()
+    conn.close()
+
+
+def _joinedload_stmt(page_size):
+    # single statement variant used before tag ids were paged separately
+    return (
+        select(Tag, TagPack, Confidence)
+        .options(joinedload(Tag.confidence))
+        .options(joinedload(Tag.concepts))
+        .options(joinedload(Tag.tag_type))
+        .options(joinedload(Tag.tag_subject))
+        .where(Tag.identifier == BENCH_ADDRESS)
+        .where(Tag.tagpack_id == TagPack.id)
+        .where(TagPack.acl_group.in_(["public"]))
+        .where(Confidence.id == Tag.confidence_id)
+        .limit(page_size)
+        .order_by(desc(Confidence.level), Tag.id)
+    )
+
+
+@pytest.mark.slow
+@pytest.mark.asyncio
+@pytest.mark.parametrize("page_size", [50, 500, 5000])
+async def test_benchmark_tags_with_many_concepts(many_concepts_db, page_size):
+    db = TagstoreDbAsync.from_url(many_concepts_db["db_connection_string_async"])
+    rounds = 5
+
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        async with AsyncSession(db.engine) as session:
+            rows = (await session.exec(_joinedload_stmt(page_size))).unique()
+            old = [TagPublic.fromDB(t, tp) for t, tp, _ in rows]
+    t_joined = (time.perf_counter() - t0) / rounds
+
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        new = await db.get_tags_by_subjectid(BENCH_ADDRESS, 0, page_size, ["public"])
+    t_two_phase = (time.perf_counter() - t0) / rounds
+
+    print(
+        f"\npage_size={page_size}: joinedload {t_joined * 1000:.1f}ms, "
+        f"id page + hydration {t_two_phase * 1000:.1f}ms"
+    )
+
+    assert len(new) == page_size
+    assert [t.label for t in new] == [t.label for t in old]
+    assert all(len(t.concepts) == NR_CONCEPTS for t in new)
+
+
+@pytest.mark.slow
+@pytest.mark.asyncio
+@pytest.mark.parametrize("page_size", [50, 500, 5000])
+async def test_benchmark_tags_serialization(many_concepts_db, page_size):
+    db = TagstoreDbAsync.from_url(many_concepts_db["db_connection_string_async"])
+    adapter = TypeAdapter(List[TagPublic])
+    rounds = 5
+
+    # before: ORM entities, validated models, FastAPI's jsonable_encoder
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        async with AsyncSession(db.engine) as session:
+            rows = (await session.exec(_joinedload_stmt(page_size))).unique()
+            tags = adapter.validate_python(
+                [TagPublic.fromDB(t, tp) for t, tp, _ in rows]
+            )
+            before = json.dumps(jsonable_encoder(tags)).encode("utf-8")
+    t_before = (time.perf_counter() - t0) / rounds
+
+    # after: plain rows, unvalidated models, serialized by pydantic-core
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        tags = await db.get_tags_by_subjectid(BENCH_ADDRESS, 0, page_size, ["public"])
+        after = adapter.dump_json(tags)
+    t_after = (time.perf_counter() - t0) / rounds
+
+    print(
+        f"\npage_size={page_size}: before {t_before * 1000:.1f}ms, "
+        f"after {t_after * 1000:.1f}ms"
+    )
+
+    def normalized(data):
+        return [
+            {
+                **t,
+                "additional_concepts": sorted(t["additional_concepts"]),
+                "concepts": sorted(t["concepts"]),
+            }
+            for t in json.loads(data)
+        ]
+
+    assert normalized(after) == normalized(before)
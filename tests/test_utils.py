@@ -1,4 +1,4 @@
-from tagpack.utils import get_secondlevel_domain
+from tagpack.utils import BloomFilter, get_secondlevel_domain
 
 
 def test_tld_extraction():
@@ -10,3 +10,17 @@ def test_tld_extraction():
     assert get_secondlevel_domain("test.eth.link") == "test.eth.link"
     assert get_secondlevel_domain("foxbit.com.br") == "foxbit.com.br"
     assert get_secondlevel_domain("gardensdao.eth.limo") == "gardensdao.eth.limo"
+
+
+def test_bloom_filter():
+    f = BloomFilter(1000, error_rate=0.01)
+    items = [f"address{i}" for i in range(1000)]
+    for item in items:
+        f.add(item)
+
+    assert all(item in f for item in items)
+    false_positives = sum(f"other{i}" in f for i in range(10_000))
+    assert false_positives < 300
+
+    f.add(b"\x00\x01")
+    assert b"\x00\x01" in f